@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# A scripted stand-in for Asterisk's side of an AGI session, for
+# benchmarking the inbound/outbound scripts without a live Asterisk.
+#
+# The driver sends the AGI environment, then answers every command the
+# script sends: GET VARIABLE returns 'variables', SWIFT_DTMF and digit
+# collecting commands (STREAM FILE with escape digits, WAIT FOR DIGIT)
+# replay 'dtmf' - a list of entries such as ['1111', '1'], each read as a
+# whole by SWIFT_DTMF or digit by digit by the others (if the digit is one
+# the command listens for). EXEC UserEvent is
+# passed on to 'on_user_event'. Every command is recorded along with the
+# time the script spent before sending it (since the previous reply).
+#
+# Usage:
+#
+# driver = ScriptedAGI({'agi_callerid' : '5551234'}, variables={}, dtmf=['1111', '1'])
+# driver.runProcess(['python', 'inbound.py'])   # or: driver.runSession(func)
+# print driver.startup, driver.elapsed, driver.commands
+#
+
+import os
+import sys
+import time
+import shlex
+import threading
+import subprocess
+
+class ScriptedAGI:
+    def __init__(self, env, variables={}, dtmf=[], on_user_event=None):
+        self.env = dict(env)
+        self.variables = dict(variables)
+        self.dtmf = list(dtmf)
+        self.on_user_event = on_user_event
+
+        self.commands = []
+        self.startup = None
+        self.elapsed = None
+        self.hungup = False
+
+    def runProcess(self, argv):
+        """
+        Runs an AGI script as a child process (as Asterisk does). 'startup'
+        is the time from spawning it until its first AGI command.
+        """
+        null_fh = open(os.devnull, 'w')
+        try:
+            started = time.time()
+            child = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=null_fh)
+            self.serve(child.stdout, child.stdin, started)
+            child.stdin.close()
+            child.wait()
+            self.elapsed = time.time() - started
+        finally:
+            null_fh.close()
+
+        return child.returncode
+
+    def runSession(self, func):
+        """
+        Runs 'func(stdin, stdout)' - an AGI session talking to the driver
+        over a pair of pipes - in the calling thread (pyst's AGI installs a
+        signal handler, so it has to be the main thread) while the driver
+        answers from a background thread.
+        """
+        (script_in, driver_out) = os.pipe()
+        (driver_in, script_out) = os.pipe()
+
+        script_files = (os.fdopen(script_in, 'r'), os.fdopen(script_out, 'w'))
+        driver_files = (os.fdopen(driver_in, 'r'), os.fdopen(driver_out, 'w'))
+
+        started = time.time()
+        thread = threading.Thread(target=self.serve, args=(driver_files[0], driver_files[1], started))
+        thread.setDaemon(True)
+        thread.start()
+
+        try:
+            func(*script_files)
+        finally:
+            for agi_fh in script_files:
+                agi_fh.close()
+            thread.join()
+            for agi_fh in driver_files:
+                agi_fh.close()
+
+        self.elapsed = time.time() - started
+
+    def serve(self, rfile, wfile, started=None):
+        """ Speaks Asterisk's side of the AGI protocol until the script exits """
+        try:
+            for (key, value) in sorted(self.env.items()):
+                wfile.write('%s: %s\n' % (key, value))
+            wfile.write('\n')
+            wfile.flush()
+            replied = time.time()
+
+            while True:
+                line = rfile.readline()
+                if not line:
+                    break
+
+                received = time.time()
+                if self.startup is None and started is not None:
+                    self.startup = received - started
+
+                self.commands.append((line.strip(), received - replied))
+                wfile.write(self.answer(line.strip()) + '\n')
+                wfile.flush()
+                replied = time.time()
+        except IOError, e:
+            # The script went away
+            pass
+
+    def answer(self, command):
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            args = command.split()
+
+        verb = ' '.join(args[:3]).upper()
+
+        if verb.startswith('GET VARIABLE') or verb.startswith('GET FULL VARIABLE'):
+            name = args[-1]
+            if name == 'SWIFT_DTMF':
+                return '200 result=1 (%s)' % self._nextEntry()
+            if name in self.variables:
+                return '200 result=1 (%s)' % self.variables[name]
+            return '200 result=0'
+
+        if verb.startswith('STREAM FILE'):
+            escape_digits = len(args) > 3 and args[3] or ''
+            digit = self._nextDigit(escape_digits)
+            return '200 result=%s endpos=8000' % (digit and ord(digit) or 0)
+
+        if verb.startswith('WAIT FOR DIGIT'):
+            digit = self._nextDigit('0123456789*#')
+            return '200 result=%s' % (digit and ord(digit) or 0)
+
+        if verb.startswith('RECORD FILE'):
+            return '200 result=%s (dtmf) endpos=40000' % ord('#')
+
+        if verb.startswith('EXEC'):
+            if len(args) > 1 and args[1].lower() == 'userevent' and self.on_user_event is not None:
+                self.on_user_event(len(args) > 2 and args[2] or '')
+            return '200 result=0'
+
+        if verb.startswith('HANGUP'):
+            self.hungup = True
+            return '200 result=1'
+
+        return '200 result=0'
+
+    def _nextEntry(self):
+        if not self.dtmf:
+            return ''
+        return self.dtmf.pop(0)
+
+    def _nextDigit(self, escape_digits):
+        # Digits the command does not listen for stay queued
+        while self.dtmf and not self.dtmf[0]:
+            self.dtmf.pop(0)
+        if not self.dtmf or self.dtmf[0][0] not in escape_digits:
+            return ''
+
+        digit = self.dtmf[0][0]
+        self.dtmf[0] = self.dtmf[0][1:]
+        if not self.dtmf[0]:
+            self.dtmf.pop(0)
+        return digit
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: ./%s dtmf[,dtmf...] script [args...]" % sys.argv[0]
+        sys.exit(1)
+
+    driver = ScriptedAGI({'agi_callerid' : '5551234', 'agi_request' : sys.argv[2]}, dtmf=sys.argv[1].split(','))
+    driver.runProcess(sys.argv[2:])
+
+    for (command, elapsed) in driver.commands:
+        print "%8.3fms  %s" % (elapsed * 1000, command)
+    print "Startup: %.3fs, session: %.3fs, %s commands" % (driver.startup or 0, driver.elapsed, len(driver.commands))
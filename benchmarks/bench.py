@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# Offline benchmark suite for pyhotline; needs pyst, but no Asterisk.
+#
+# Runs against a scratch db/config in a temp dir:
+#
+#   startup  - inbound AGI script started as a child process, as Asterisk
+#              does (time until its first AGI command, whole session)
+#   inbound  - inbound sessions (pin, record, confirm) run in-process
+#              through the scripted AGI driver
+#   outbound - outbound sessions (accept) run the same way
+#   queue    - a queue run dispatching '--issues' issues through the fake
+#              AMI server; answered calls are accepted (or rejected) the
+#              way the outbound script would - db update plus accept event;
+#              with '--unreachable' the first contacts never answer, with
+#              '--refused' the contacts after those fail every originate
+#
+# Every session reports its latency and per-call db cost (number of _SQL
+# calls and the time spent in them); the queue reports issues dispatched
+# per minute.
+#
+# Usage:
+#
+# ./bench.py [options] [startup] [inbound] [outbound] [queue]
+#
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyhotline
+from asterisk import agi
+from fakeami import FakeAMIServer
+from agidriver import ScriptedAGI
+
+group = 'benchhotline'
+
+class DBCost:
+    """ Counts and times every public _SQL method call """
+    def __init__(self):
+        self.calls = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def install(self):
+        for name in dir(pyhotline._SQL):
+            func = getattr(pyhotline._SQL, name)
+            if name.startswith('_') or name == 'setupDatabase' or not callable(func):
+                continue
+            setattr(pyhotline._SQL, name, self._wrap(func))
+
+    def snapshot(self):
+        return (self.calls, self.elapsed)
+
+    def _wrap(self, func):
+        cost = self
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                cost.lock.acquire()
+                try:
+                    cost.calls += 1
+                    cost.elapsed += time.time() - start
+                finally:
+                    cost.lock.release()
+        return wrapper
+
+class Bench:
+    def __init__(self, options):
+        self.options = options
+        self.tmp_dir = tempfile.mkdtemp(prefix='pyhotline-bench-')
+        self.db_file = os.path.join(self.tmp_dir, 'hotline.db')
+        self.config_file = os.path.join(self.tmp_dir, 'pyhotline.conf')
+        self.message_dir = os.path.join(self.tmp_dir, 'messages')
+        self.null_fh = open(os.devnull, 'w')
+
+        os.makedirs(self.message_dir)
+        (status, error) = pyhotline._SQL.setupDatabase(self.db_file)
+        if not status:
+            raise Exception("Unable to create db: %s" % error)
+
+        self.sql = pyhotline._SQL(self.db_file)
+        self.sql.cur.execute("DELETE FROM clients")
+        for n in xrange(options.clients):
+            self.sql.cur.execute("INSERT INTO clients (name, pin) VALUES (?, ?)", ('Client %s' % n, 1000 + n))
+        self.sql.con.commit()
+        self.client_id = self.sql.fetchClientByPin(1000).client_id
+
+        no_answer = ['Local/%s@bench-out' % self._number(n) for n in xrange(options.unreachable)]
+        refuse = ['Local/%s@bench-out' % self._number(n) for n in xrange(options.unreachable, options.unreachable + options.refused)]
+        self.ami = FakeAMIServer(answer_delay=options.answer_delay, jitter=options.answer_delay / 2,
+                                 failure_rate=options.failure_rate, on_answer=self._callee,
+                                 no_answer=no_answer, refuse=refuse).start()
+        self._writeConfig()
+
+        self.cost = DBCost()
+        self.cost.install()
+
+    def close(self):
+        self.ami.stop()
+        self.null_fh.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def startup(self):
+        script = os.path.join(self.tmp_dir, 'inbound.py')
+        script_fh = open(script, 'w')
+        script_fh.write("import sys\nsys.path[:0] = %r\n" % sys.path[:2])
+        script_fh.write("from pyhotline import Inbound\nInbound(%r, %r).run()\n" % (self.config_file, group))
+        script_fh.close()
+
+        startups = []
+        sessions = []
+        for n in xrange(self.options.calls):
+            driver = ScriptedAGI(self._env(), dtmf=['1000', '1'])
+            driver.runProcess([sys.executable, script])
+            startups.append(driver.startup)
+            sessions.append(driver.elapsed)
+
+        self._report('startup', "time to first AGI command", startups)
+        self._report('startup', "session (child process)", sessions)
+
+    def inbound(self):
+        def session(driver):
+            return lambda stdin, stdout: pyhotline.Inbound(self.config_file, group, agi_obj=agi.AGI(stdin, stdout, self.null_fh)).run()
+
+        self._sessions('inbound', lambda n: ScriptedAGI(self._env(), dtmf=['%s' % (1000 + n % self.options.clients), '1']), session)
+
+    def outbound(self):
+        def driver(n):
+            msg_id = 'bench%015d' % n
+            issue_id = self.sql.insertMessage(self.client_id, msg_id, '5551234')
+            variables = {'id' : issue_id, 'msg_id' : msg_id, 'name' : 'Client 0', 'contact' : 'Bench', 'call_id' : ''}
+            return ScriptedAGI(self._env(), variables=variables, dtmf=['1', '2', ''])
+
+        def session(driver):
+            return lambda stdin, stdout: pyhotline.Outbound(self.config_file, group, agi_obj=agi.AGI(stdin, stdout, self.null_fh)).run()
+
+        self._sessions('outbound', driver, session)
+
+    def queue(self):
+        self.sql.cur.execute("UPDATE messages SET status=1 WHERE status IN (0, 3)")
+        for n in xrange(self.options.issues):
+            self.sql.insertMessage(self.client_id, 'queue%015d' % n, '5551234')
+
+        queue = pyhotline.Queue(self.config_file, group)
+        before = self.cost.snapshot()
+        started = time.time()
+        queue.run()
+        elapsed = time.time() - started
+        (calls, db_elapsed) = [after - start for (after, start) in zip(self.cost.snapshot(), before)]
+
+        # Accepted and given up issues both end up with status 2; only the
+        # former have an 'employee'
+        self.sql.cur.execute("SELECT COUNT(employee) AS accepted, SUM(status = 2 AND employee IS NULL) AS given_up, SUM(status = 0) AS retrying " +
+                             "FROM messages WHERE msg_id LIKE 'queue%'")
+        row = self.sql.cur.fetchone()
+        queue.session.close()
+
+        print "queue     %s issues in %.2fs: %.1f issues dispatched per minute (%s, %s contact order, answer delay %ss, failure rate %s)" % \
+              (self.options.issues, elapsed, self.options.issues / elapsed * 60,
+               self.options.batch_calls and 'batch calls' or 'concurrency %s' % self.options.concurrency,
+               self.options.contact_order, self.options.answer_delay, self.options.failure_rate)
+        print "queue     %s accepted, %s given up, %s waiting for a retry; fake AMI: %s" % \
+              (row['accepted'], row['given_up'], row['retrying'], ', '.join(['%s=%s' % item for item in sorted(self.ami.stats.items())]))
+        print "queue     db cost: %.1f calls / %.2fms per issue" % (float(calls) / self.options.issues, db_elapsed * 1000 / self.options.issues)
+
+    def _sessions(self, name, make_driver, make_session):
+        latencies = []
+        commands = []
+        before = self.cost.snapshot()
+
+        for n in xrange(self.options.calls):
+            driver = make_driver(n)
+            driver.runSession(make_session(driver))
+            latencies.append(driver.elapsed)
+            commands.append(len(driver.commands))
+
+        (calls, db_elapsed) = [after - start for (after, start) in zip(self.cost.snapshot(), before)]
+
+        self._report(name, "session (in-process)", latencies)
+        print "%-9s %.1f AGI commands, %.1f db calls / %.2fms db time per call" % \
+              (name, float(sum(commands)) / len(commands), float(calls) / self.options.calls, db_elapsed * 1000 / self.options.calls)
+
+    def _callee(self, ami, channel, variables):
+        # Plays the contact on the other end of an answered call
+        def answer():
+            # Calls about several issues ('batch_calls') carry all of their ids
+            for issue_id in variables['id'].split(':'):
+                time.sleep(self.options.think_time)
+                if random.random() < self.options.accept_rate:
+                    self.sql.acceptIssue(int(issue_id), variables.get('contact'))
+                    ami.sendEvent('UserEvent', [('UserEvent', 'HotlineAccept'), ('CallID', variables.get('call_id', ''))])
+            time.sleep(self.options.think_time)
+            ami.hangup(channel)
+
+        thread = threading.Thread(target=answer)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _number(self, n):
+        return str(100 + n)
+
+    def _env(self):
+        return {'agi_request'  : 'bench.py',
+                'agi_channel'  : 'Local/bench',
+                'agi_callerid' : '5551234'}
+
+    def _report(self, name, label, values):
+        values = sorted(values)
+        print "%-9s %s: min %.1fms, median %.1fms, max %.1fms (%s runs)" % \
+              (name, label, values[0] * 1000, values[len(values) / 2] * 1000, values[-1] * 1000, len(values))
+
+    def _writeConfig(self):
+        # One priority tier; contacts are called in config order unless
+        # the contact order is 'adaptive'
+        contacts = [{'name'      : 'Bench %s' % n,
+                     'number'    : self._number(n),
+                     'schedule'  : range(7),
+                     'emergency' : n == 0,
+                     'priority'  : 10} for n in xrange(3)]
+
+        config = {'main'   : {'manager_host'        : '127.0.0.1',
+                              'manager_port'        : self.ami.port,
+                              'manager_username'    : 'bench',
+                              'manager_password'    : 'bench',
+                              'origin_timeout'      : self.options.origin_timeout,
+                              'hangup_timeout'      : 30,
+                              'outbound_context'    : 'bench-out',
+                              'outbound_prepend'    : False,
+                              'smtp_host'           : 'localhost',
+                              'smtp_port'           : 25},
+                  'groups' : {group : {'sqlite_database'      : self.db_file,
+                                       'message_dir'          : self.message_dir,
+                                       'log_file'             : os.path.join(self.tmp_dir, 'hotline.log'),
+                                       'log_level'            : 'warning',
+                                       'team_name'            : 'Bench',
+                                       'caller_id'            : '5550000',
+                                       'email_phonetic'       : 'bench at example dot com',
+                                       'email_notify'         : False,
+                                       'email_to'             : False,
+                                       'email_from'           : False,
+                                       'max_attempts'         : 1,
+                                       'max_concurrent_calls' : self.options.concurrency,
+                                       'batch_calls'          : self.options.batch_calls,
+                                       'contact_order'        : self.options.contact_order,
+                                       'prompt_cache_size'    : 0,
+                                       'contacts'             : contacts}}}
+
+        config_fh = open(self.config_file, 'w')
+        json.dump(config, config_fh, indent=4)
+        config_fh.close()
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] [startup] [inbound] [outbound] [queue]")
+    parser.add_option('--calls', type='int', default=20, help="AGI sessions per session benchmark [%default]")
+    parser.add_option('--clients', type='int', default=1000, help="client accounts in the db [%default]")
+    parser.add_option('--issues', type='int', default=50, help="issues dispatched by the queue benchmark [%default]")
+    parser.add_option('--concurrency', type='int', default=10, help="max_concurrent_calls for the queue [%default]")
+    parser.add_option('--batch-calls', action='store_true', default=False, help="call each contact once about all pending issues")
+    parser.add_option('--contact-order', choices=['priority', 'adaptive'], default='priority', help="contact_order for the queue [%default]")
+    parser.add_option('--unreachable', type='int', default=0, help="contacts (of 3) that never answer [%default]")
+    parser.add_option('--refused', type='int', default=0, help="contacts (of 3) after the unreachable ones whose calls always fail [%default]")
+    parser.add_option('--origin-timeout', type='int', default=10, help="origin_timeout in seconds [%default]")
+    parser.add_option('--answer-delay', type='float', default=0.2, help="seconds until a call is answered [%default]")
+    parser.add_option('--failure-rate', type='float', default=0.1, help="share of failing originates [%default]")
+    parser.add_option('--accept-rate', type='float', default=0.8, help="share of answered calls that accept [%default]")
+    parser.add_option('--think-time', type='float', default=0.1, help="seconds a contact takes to accept and to hang up [%default]")
+    (options, args) = parser.parse_args()
+
+    # Pins are 4 digits long
+    if not 0 < options.clients <= 9000:
+        parser.error("--clients has to be between 1 and 9000")
+
+    benchmarks = args or ['startup', 'inbound', 'outbound', 'queue']
+    for name in benchmarks:
+        if name not in ('startup', 'inbound', 'outbound', 'queue'):
+            parser.error("Unknown benchmark '%s'" % name)
+
+    bench = Bench(options)
+    try:
+        for name in benchmarks:
+            getattr(bench, name)()
+    finally:
+        bench.close()
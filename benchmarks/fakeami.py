@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# A fake Asterisk Manager Interface (AMI) server for benchmarking the queue
+# runner without a live Asterisk.
+#
+# Originate actions are acknowledged right away; after 'answer_delay'
+# seconds (+/- 'jitter') an OriginateResponse event reports the call as
+# answered, or as failed for 'failure_rate' of the calls. Answered calls
+# are handed to 'on_answer' (if set) - ie. to simulate the contact in the
+# outbound script - and hang up after 'call_duration' seconds unless they
+# were hung up through a Hangup action first. Calls to the channels in
+# 'no_answer' ring forever (no OriginateResponse at all), calls to the
+# channels in 'refuse' always fail. Events are sent to every connected
+# manager session.
+#
+# Standalone usage:
+#
+# ./fakeami.py [port] [answer_delay] [failure_rate]
+#
+
+import sys
+import time
+import random
+import threading
+import SocketServer
+
+class FakeAMIServer:
+    def __init__(self, host='127.0.0.1', port=0, answer_delay=0.5, jitter=0.0,
+                 failure_rate=0.0, call_duration=5.0, on_answer=None, no_answer=(), refuse=()):
+        self.answer_delay = answer_delay
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.call_duration = call_duration
+        self.on_answer = on_answer
+        self.no_answer = set(no_answer)
+        self.refuse = set(refuse)
+
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.channels = {}
+        self.seq = 0
+        self.stats = {'originates' : 0, 'answered' : 0, 'failed' : 0, 'unanswered' : 0, 'hangups' : 0, 'actions' : 0}
+
+        self.server = _FakeAMITCPServer((host, port), _FakeAMIHandler)
+        self.server.ami = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sendEvent(self, name, headers):
+        """ Sends an event to every connected manager session """
+        message = self._format([('Event', name)] + list(headers))
+
+        self.lock.acquire()
+        try:
+            sessions = list(self.sessions)
+        finally:
+            self.lock.release()
+
+        for session in sessions:
+            session.send(message)
+
+    def hangup(self, channel, cause='16'):
+        """ Hangs up an answered channel (once) """
+        self.lock.acquire()
+        try:
+            unique_id = self.channels.pop(channel, None)
+            if unique_id is not None:
+                self.stats['hangups'] += 1
+        finally:
+            self.lock.release()
+
+        if unique_id is None:
+            return False
+
+        self.sendEvent('Hangup', [('Channel', channel), ('Uniqueid', unique_id), ('Cause', cause)])
+        return True
+
+    def _action(self, session, action):
+        name = action.get('Action', '').lower()
+        action_id = action.get('ActionID', '')
+
+        self.lock.acquire()
+        try:
+            self.stats['actions'] += 1
+        finally:
+            self.lock.release()
+
+        if name == 'login':
+            session.respond(action_id, 'Success', [('Message', 'Authentication accepted')])
+        elif name == 'logoff':
+            session.respond(action_id, 'Goodbye', [('Message', 'Thanks for all the fish.')])
+            session.close()
+        elif name == 'ping':
+            session.respond(action_id, 'Success', [('Ping', 'Pong')])
+        elif name == 'originate':
+            session.respond(action_id, 'Success', [('Message', 'Originate successfully queued')])
+            self._originate(action)
+        elif name == 'hangup':
+            if self.hangup(action.get('Channel', '')):
+                session.respond(action_id, 'Success', [('Message', 'Channel Hungup')])
+            else:
+                session.respond(action_id, 'Error', [('Message', 'No such channel')])
+        elif name == 'userevent':
+            headers = [(key, value) for (key, value) in action.items() if key not in ('Action', 'ActionID', 'UserEvent')]
+            self.sendEvent('UserEvent', [('UserEvent', action.get('UserEvent', ''))] + headers)
+            session.respond(action_id, 'Success', [('Message', 'Event Sent')])
+        else:
+            session.respond(action_id, 'Error', [('Message', 'Invalid/unknown command')])
+
+    def _originate(self, action):
+        self.lock.acquire()
+        try:
+            self.seq += 1
+            unique_id = '%.6f.%d' % (time.time(), self.seq)
+            channel = '%s-%08x;1' % (action.get('Channel', 'Local/unknown'), self.seq)
+            self.stats['originates'] += 1
+            if action.get('Channel') in self.no_answer:
+                self.stats['unanswered'] += 1
+                return
+        finally:
+            self.lock.release()
+
+        variables = {}
+        for variable in action.get('Variable', []):
+            (key, value) = variable.split('=', 1)
+            variables[key] = value
+
+        delay = max(self.answer_delay + random.uniform(-self.jitter, self.jitter), 0)
+        timer = threading.Timer(delay, self._answer, args=(action, channel, unique_id, variables))
+        timer.setDaemon(True)
+        timer.start()
+
+    def _answer(self, action, channel, unique_id, variables):
+        headers = [('ActionID', action.get('ActionID', '')), ('Channel', action.get('Channel', ''))]
+
+        if action.get('Channel') in self.refuse or random.random() < self.failure_rate:
+            self.lock.acquire()
+            try:
+                self.stats['failed'] += 1
+            finally:
+                self.lock.release()
+            self.sendEvent('OriginateResponse', headers + [('Response', 'Failure'), ('Reason', '3'), ('Uniqueid', '<null>')])
+            return
+
+        self.lock.acquire()
+        try:
+            self.channels[channel] = unique_id
+            self.stats['answered'] += 1
+        finally:
+            self.lock.release()
+
+        headers[1] = ('Channel', channel)
+        self.sendEvent('OriginateResponse', headers + [('Response', 'Success'), ('Reason', '4'), ('Uniqueid', unique_id)])
+
+        if self.on_answer is not None:
+            self.on_answer(self, channel, variables)
+            return
+
+        timer = threading.Timer(self.call_duration, self.hangup, args=(channel,))
+        timer.setDaemon(True)
+        timer.start()
+
+    def _format(self, headers):
+        return ''.join(['%s: %s\r\n' % (key, value) for (key, value) in headers]) + '\r\n'
+
+class _FakeAMITCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _FakeAMIHandler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+        self.closed = False
+
+    def handle(self):
+        ami = self.server.ami
+        self.send('Asterisk Call Manager/1.1\r\n')
+
+        ami.lock.acquire()
+        try:
+            ami.sessions.append(self)
+        finally:
+            ami.lock.release()
+
+        try:
+            action = {}
+            while not self.closed:
+                line = self.rfile.readline()
+                if not line:
+                    break
+
+                line = line.rstrip('\r\n')
+                if line:
+                    if ':' not in line:
+                        continue
+                    (key, value) = [part.strip() for part in line.split(':', 1)]
+                    if key == 'Variable':
+                        action.setdefault(key, []).append(value)
+                    else:
+                        action[key] = value
+                    continue
+
+                if action:
+                    ami._action(self, action)
+                action = {}
+        finally:
+            ami.lock.acquire()
+            try:
+                ami.sessions.remove(self)
+            finally:
+                ami.lock.release()
+
+    def respond(self, action_id, response, headers):
+        self.send(self.server.ami._format([('Response', response), ('ActionID', action_id)] + headers))
+
+    def send(self, message):
+        self.write_lock.acquire()
+        try:
+            if self.closed:
+                return
+
+            try:
+                self.wfile.write(message)
+                self.wfile.flush()
+            except Exception, e:
+                self.closed = True
+        finally:
+            self.write_lock.release()
+
+    def close(self):
+        self.closed = True
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    port = len(args) > 0 and int(args[0]) or 5038
+    answer_delay = len(args) > 1 and float(args[1]) or 0.5
+    failure_rate = len(args) > 2 and float(args[2]) or 0.0
+
+    ami = FakeAMIServer(port=port, answer_delay=answer_delay, failure_rate=failure_rate).start()
+    print "Fake AMI server listening on 127.0.0.1:%s (answer delay %ss, failure rate %s)" % (ami.port, answer_delay, failure_rate)
+
+    try:
+        while True:
+            time.sleep(10)
+            print "Stats: %s" % ', '.join(['%s=%s' % (key, ami.stats[key]) for key in sorted(ami.stats.keys())])
+    except KeyboardInterrupt:
+        ami.stop()
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+#
+# pyhotline example FastAGI server script
+#
+# Hosts the inbound and outbound sessions of every hotline group; point
+# Asterisk at agi://127.0.0.1/<group>/inbound and .../<group>/outbound
+# instead of the hotline-inbound.py/hotline-outbound.py scripts.
+# Stops on SIGTERM/SIGINT.
+#
+
+from pyhotline import FastAGIServer
+
+config = '/etc/pyhotline.conf'
+
+server_obj = FastAGIServer(config)
+server_obj.run()
@@ -2,11 +2,21 @@
 #
 # pyhotline example inbound script
 #
+# Run with '--check' after editing the config to validate it and refresh
+# the config cache used on the call path.
+#
+
+import sys
 
-from pyhotline import Inbound
+from pyhotline import Inbound, checkConfig
 
 config = '/etc/pyhotline.conf'
 group  = 'myhotline'
 
+if '--check' in sys.argv[1:]:
+    (status, message) = checkConfig(config, [group])
+    print message
+    sys.exit(not status and 1 or 0)
+
 inbound_obj = Inbound(config, group)
 inbound_obj.run()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+#
+# pyhotline example queue script serving every hotline group in the config
+# from one process over one manager connection.
+#
+# Run from cron without arguments, or start once with '--daemon'.
+#
+
+import sys
+
+from pyhotline import MultiQueue
+
+config = '/etc/pyhotline.conf'
+
+multi_obj = MultiQueue(config)
+
+if '--daemon' in sys.argv[1:]:
+    multi_obj.runDaemon()
+else:
+    multi_obj.run()
@@ -2,6 +2,11 @@
 #
 # pyhotline example queue script
 #
+# Run from cron without arguments, or start once with '--daemon' to keep
+# a persistent queue runner (stops on SIGTERM/SIGINT).
+#
+
+import sys
 
 from pyhotline import Queue
 
@@ -9,4 +14,8 @@ config = '/etc/pyhotline.conf'
 group  = 'myhotline'
 
 queue_obj = Queue(config, group)
-queue_obj.run()
+
+if '--daemon' in sys.argv[1:]:
+    queue_obj.runDaemon()
+else:
+    queue_obj.run()
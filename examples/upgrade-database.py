@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+# A helper script for upgrading an existing SQLite client/message database
+# to the current schema (this also happens when the config is validated,
+# ie. 'hotline-inbound.py --check')
+#
+
+import os
+import sys
+
+from pyhotline import _SQL
+
+if len(sys.argv) != 2:
+    print "Usage: ./%s db_file" % sys.argv[0]
+    sys.exit(1)
+
+db_file = sys.argv[1]
+
+if not os.path.exists(db_file):
+    print "db_file '%s' does not exist." % db_file
+    sys.exit(1)
+
+try:
+    sql = _SQL(db_file)
+    applied = sql.upgradeSchema()
+except Exception, e:
+    print "Unable to upgrade database. Exception: %s" % e
+    sys.exit(1)
+
+print "Database upgrade completed (%s migrations applied, schema version %s)." % (applied, sql.fetchSchemaVersion())
+sys.exit(0)
@@ -37,16 +37,17 @@ Project home: http://code.google.com/p/pyhotline/
 
 __version__ = '0.3.0'
 
-import os, sys, time, random, string, smtplib, logging, datetime
+import os, re, sys, time, random, string, smtplib, logging, datetime, threading, signal, tempfile
+import select, socket, SocketServer, BaseHTTPServer, base64, errno, subprocess, heapq
 
-from operator import itemgetter
+from operator import attrgetter
+# Aliased; 'Queue' is the queue runner class below
+import Queue as _queue
 from asterisk import manager
 from asterisk import agi
-from email.MIMEMultipart import MIMEMultipart
 from email.MIMEBase import MIMEBase
 from email.MIMEText import MIMEText
 from email.Utils import COMMASPACE, formatdate
-from email import Encoders
 
 try:
     import sqlite3
@@ -58,90 +59,155 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+# Elapsed-time clock. Python 2 has no time.monotonic, so this is the wall
+# clock there: a clock jump (ie. NTP stepping the time) shifts every pending
+# deadline and skews the measured durations by the size of the jump
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# (log file, format, async) -> handler; shared by every group logging to
+# the same file the same way
+_log_handlers = {}
+
+# Db file -> _ClientIndex; only registered by long-lived processes
+_client_indexes = {}
+
 class _Base:
     """ 
     Initializes all required objects; contains all the asterisk/agi/manager
     wrapper functions.
     """
 
-    def __init__(self, config_file, group, use_agi=False, use_mgr=False): 
+    def __init__(self, config_file, group, use_agi=False, conf=None, agi_obj=None): 
         self.config_file = config_file
         self.group = group
         
-        # Validate and parse the config
-        config = _Config(self.config_file, self.group)
-        (status, self.conf) = config.parse()
-        
-        if not status:
-            print "[ConfigError] %s" % self.conf
-            sys.exit(1)
+        # Validate and parse the config, unless the caller already did so
+        if conf is None:
+            config = _Config(self.config_file, self.group)
+            (status, conf) = config.parse()
+            
+            if not status:
+                print "[ConfigError] %s" % conf
+                sys.exit(1)
+
+        self.conf = conf
 
         self.sql = _SQL(self.conf['sqlite_database'])
-        self.log = self._setupLogging(self.conf['log_file'], self.conf['log_level'])
+        self.store = _MessageStore(self.conf['message_dir'])
+        self.log = self._setupLogging(self.conf['log_file'], self.conf['log_level'], self.conf['log_format'], self.conf['log_async'])
         
-        if use_agi: self.agi = agi.AGI()
-        if use_mgr: self.mgr = manager.Manager()
+        if use_agi: self.agi = _AGISession(agi_obj or agi.AGI(), self.log)
+
+        # Static prompts are played from pre-rendered files (see say())
+        self.prompts = None
+        self.dtmf = None
+        if use_agi and self.conf['prompt_cache_size']:
+            cache_dir = self.conf['prompt_cache_dir'] or os.path.join(self.conf['message_dir'], 'prompts')
+            try:
+                self.prompts = _PromptCache(cache_dir, self.conf['prompt_cache_size'], self.conf['tts_voice'],
+                                            self.conf['swift_path'], self.log)
+            except OSError, e:
+                self.log.warning("Prompt cache disabled; Exception: %s", e)
 
     def playMessage(self, id):
-        return self.agi.stream_file(self.conf['message_dir'] + '/' + id, '#')
+        return self.agi.stream_file(self.store.path(id), '#')
 
     def recordMessage(self, id):
-        self.agi.record_file(self.conf['message_dir'] + '/' + id, 'gsm', '#', 30000)
+        self.agi.record_file(self.store.path(id), 'gsm', '#', 30000)
 
-    def say(self, msg):
+    def say(self, msg, cache=False):
+        """
+        Speaks 'msg' ("text[|timeout|max digits]", as taken by Swift). Static
+        prompts ('cache') are played from the prompt cache when possible;
+        either way the entered digits are returned by getDTMF().
+        """
+        if cache and self.prompts is not None:
+            fields = msg.split('|')
+            path = self.prompts.lookup(fields[0])
+            if path is not None:
+                return self._playPrompt(path, *[int(field) for field in fields[1:3]])
+
+        self.dtmf = None
         try:
             self.agi.appexec('Swift', msg)
         except Exception, e:
-            self.log.critical("Unable to say(); Exception: %s" % (e))
+            self.log.critical("Unable to say(); Exception: %s", e)
             return False
 
         return True
 
-    def managerLogin(self):
+    def prompt(self, msg, cache=False):
+        """ Speaks 'msg' (see say()) and returns the digits entered """
+        if not self.say(msg, cache):
+            return ''
+        return self.getDTMF()
+
+    def getDTMF(self):
+        """ Returns the digits entered during the last say() """
+        if self.dtmf is not None:
+            return self.dtmf
+        return self.agi.get_variable('SWIFT_DTMF')
+
+    def _playPrompt(self, path, timeout=0, digits=0):
+        # Mirrors Swift: any digit interrupts the prompt, then up to 'digits'
+        # digits are collected, waiting up to 'timeout' ms for each
+        self.dtmf = ''
         try:
-            self.mgr.connect(self.conf['manager_host'], self.conf['manager_port'])
-            self.mgr.login(self.conf['manager_username'], self.conf['manager_password'])
-            return True
+            if digits:
+                self.dtmf = self.agi.stream_file(path, '0123456789*#') or ''
+            else:
+                self.agi.stream_file(path)
+
+            while len(self.dtmf) < digits:
+                digit = self.agi.wait_for_digit(timeout)
+                if not digit:
+                    break
+                self.dtmf += digit
         except Exception, e:
-            self.log.critical("ERROR: Unable to start manager connection. Exception: %s)" % e)
+            self.log.critical("Unable to play prompt; Exception: %s", e)
             return False
 
-    def call(self, number, channel_vars={}):
-        """
-        We utilize async=True, as we need to catch the OriginateResponse event,
-        which contains the Uniqueid used for identifying the associated hangup
-        event. Maybe there is a cleaner way to acquire Uniqueid? 
-        """
-        prepend = ''
-        if self.conf['outbound_prepend']:
-            prepend = str(self.conf['outbound_prepend'])
-
-        out_channel = 'Local/' + prepend + number + '@' + self.conf['outbound_context']
-
-        response = self.mgr.originate(channel   = out_channel,
-                                      exten     = 's', 
-                                      context   = self.group,
-                                      priority  = '1', 
-                                      timeout   = self.conf['origin_timeout'] * 1000, 
-                                      caller_id = self.conf['caller_id'], 
-                                      async     = True,
-                                      variables = channel_vars)
-        return response
+        return True
 
-    def _setupLogging(self, log_file, log_level):
+    def _setupLogging(self, log_file, log_level, log_format='text', log_async=False):
         levels = {'info'     : logging.INFO,
                   'warning'  : logging.WARNING,
                   'error'    : logging.ERROR,
                   'critical' : logging.CRITICAL,
                   'debug'    : logging.DEBUG}
 
-        logging.basicConfig(level    = levels[log_level],
-                            format   = '[%(asctime)s] %(levelname)s %(message)s',
-                            datefmt  = '%D %H:%M:%S',
-                            filename = log_file,
-                            filemode = 'a')
+        # One logger per group, so groups served by the same process
+        # (MultiQueue) still log to their own log_file
+        logger = logging.getLogger('Base.%s' % self.group)
+        logger.setLevel(levels[log_level])
+        logger.propagate = False
+
+        key = (log_file, log_format, log_async)
+        if key not in _log_handlers:
+            handler = logging.FileHandler(log_file, 'a')
+            if log_format == 'json':
+                handler.setFormatter(_JSONFormatter())
+            else:
+                handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(message)s', '%D %H:%M:%S'))
+
+            # Written from a background thread (see _AsyncLogHandler)
+            if log_async:
+                handler = _AsyncLogHandler(handler)
+            _log_handlers[key] = handler
+
+        if _log_handlers[key] not in logger.handlers:
+            logger.addHandler(_log_handlers[key])
 
-        logger = logging.getLogger('Base')
         return logger
 
 class Inbound(_Base):
@@ -162,38 +228,52 @@ class Inbound(_Base):
     inbound_obj = Inbound('/etc/pyhotline.conf', 'myhotline')
     inbound_obj.run()
     """
-    def __init__(self, config_file, group):
-        _Base.__init__(self, config_file, group, use_agi=True)
+    def __init__(self, config_file, group, conf=None, agi_obj=None):
+        _Base.__init__(self, config_file, group, use_agi=True, conf=conf, agi_obj=agi_obj)
 
     def run(self):
-        if self.sql.fetchClientCount() == 0:
+        try:
+            self._run()
+        finally:
+            self.agi.logStats()
+
+    def _run(self):
+        # Long-lived processes (FastAGIServer) keep an in-memory pin index
+        clients = _client_indexes.get(self.conf['sqlite_database'])
+        if clients:
+            configured = clients.count(self.sql) > 0
+        else:
+            configured = self.sql.hasClients()
+
+        if not configured:
             self.log.warning("SQLite 'clients' table is empty. Hotline will not be active until this is corrected")
-            self.say("Welcome to the %s hotline. It appears this hotline is not fully configured. Please call back later." % self.conf['team_name'])
+            self.say("Welcome to the %s hotline. It appears this hotline is not fully configured. Please call back later." % self.conf['team_name'], cache=True)
             self.agi.hangup()
             return 
 
-        self.say("Welcome to the %s hotline. Please enter your customer pin number. |8000|4" % self.conf['team_name'])
-        pin = self.agi.get_variable('SWIFT_DTMF')
+        pin = self.prompt("Welcome to the %s hotline. Please enter your customer pin number. |8000|4" % self.conf['team_name'], cache=True)
+
+        if clients:
+            client = clients.lookup(self.sql, pin)
+        else:
+            client = self.sql.fetchClientByPin(pin)
 
-        client = self.sql.fetchClientByPin(pin)
         if not client:
             self.say("Invalid pin number. Good bye! You entered: %s" % pin)
             self.agi.hangup()
             return
 
-        msg_id = _Misc.genRandom()
+        msg_id = self.store.newId()
 
         record_complete = False
         while record_complete == False:
-            self.say("Please provide a brief description of the issue you are experiencing followed by the pound key.")
+            self.say("Please provide a brief description of the issue you are experiencing followed by the pound key.", cache=True)
             self.recordMessage(msg_id)
 
             while True:
-                self.say("If you are satisfied with your message please press 1. " + \
-                         "If you would like to record a new message please press 2. " + \
-                         "If you would like to play back the current message please press 3.|5000|1")
-
-                record_pin = self.agi.get_variable('SWIFT_DTMF')
+                record_pin = self.prompt("If you are satisfied with your message please press 1. " + \
+                                         "If you would like to record a new message please press 2. " + \
+                                         "If you would like to play back the current message please press 3.|5000|1", cache=True)
 
                 if record_pin == '3':
                     self.playMessage(msg_id)
@@ -205,11 +285,13 @@ class Inbound(_Base):
                     record_complete = True
                     break
 
-        record_id = self.sql.insertMessage(client['client_id'], msg_id, self.agi.env['agi_callerid'])
+        (record_id, attached) = self.sql.ingestMessage(client.client_id, msg_id, self.agi.env['agi_callerid'], self.conf['coalesce_window'])
+        if attached:
+            self.log.info("Recording %s attached to open issue #%s", msg_id, record_id, extra={'issue' : record_id})
 
         self.say("Thank you. Your message will be relayed to a member of the %s team immediatelly. " % self.conf['team_name'] + \
                  "In addition please send an email to %s detailing the problems you are experiencing. " % self.conf['email_phonetic'] + \
-                 "Have a nice day!")
+                 "Have a nice day!", cache=True)
 
         self.agi.hangup()
 
@@ -239,384 +321,3106 @@ class Outbound(_Base):
     outbound_obj = Outbound('/etc/pyhotline.conf', 'myhotline')
     outbound_obj.run()
     """
-    def __init__(self, config_file, group):
-        _Base.__init__(self, config_file, group, use_agi=True)
+    def __init__(self, config_file, group, conf=None, agi_obj=None):
+        _Base.__init__(self, config_file, group, use_agi=True, conf=conf, agi_obj=agi_obj)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            self.agi.logStats()
+
+    def _run(self):
+        # Calls about several issues ('batch_calls') carry all of their ids
+        ids = [int(x) for x in self.agi.variable('id').split(':')]
+        if len(ids) > 1:
+            self._runBatch(ids)
+            return
+
+        # With parallel/staggered ring strategies another contact may have
+        # accepted the issue while this call was ringing
+        if self.sql.fetchStatus(ids[0]) not in (0, 3):
+            self.say("Hello. This is the %s hotline calling. "
+                     "The issue has already been accepted by another contact. Good bye." % self.conf['team_name'], cache=True)
+            self.agi.hangup()
+            return
+
         self.say("Hello. This is the %s hotline calling. " 
-                 "A new trouble issue has been created by %s" % (self.conf['team_name'], self.agi.get_variable('name')))
+                 "A new trouble issue has been created by %s" % (self.conf['team_name'], self.agi.variable('name')))
         
         while True:
-            self.say("Please press 1 to listen to the message, press 2 to accept the issue or press 3 to reject the issue.|5000|1")
-            data = self.agi.get_variable('SWIFT_DTMF')
+            data = self.prompt("Please press 1 to listen to the message, press 2 to accept the issue or press 3 to reject the issue.|5000|1", cache=True)
             
             if not data:
-                self.say("Timeout reached. The issue has been automatically rejected. Good bye.")
+                self.say("Timeout reached. The issue has been automatically rejected. Good bye.", cache=True)
                 self.agi.hangup()
                 return
 
             if data == '1':
-                self.playMessage(self.agi.get_variable('msg_id'))
+                self._playIssue(ids[0], self.agi.variable('msg_id'))
                 continue
             
             if data == '2':
-                self.sql.updateStatus(int(self.agi.get_variable('id')), 1)
-                self.say("Thank you. The issue has been marked as accepted.")
+                if not self.sql.acceptIssue(ids[0], self.agi.variable('contact') or None):
+                    self.say("Sorry, the issue has already been accepted by another contact. Good bye.", cache=True)
+                    self.agi.hangup()
+                    return
+
+                self._notifyAccepted()
+                self.say("Thank you. The issue has been marked as accepted.", cache=True)
                 break
                 
             if data == '3':
-                self.say("Thank you. The issue has been rejected. Good bye.")
+                self.say("Thank you. The issue has been rejected. Good bye.", cache=True)
                 self.agi.hangup()
                 return
        
         while True:
-            self.say("Please press 1 to listen to the message again or hang up at any time.|5000|1")
-            listen_again = self.agi.get_variable('SWIFT_DTMF')
+            listen_again = self.prompt("Please press 1 to listen to the message again or hang up at any time.|5000|1", cache=True)
             
             if listen_again == '1':
-                self.playMessage(self.agi.get_variable('msg_id'))
+                self._playIssue(ids[0], self.agi.variable('msg_id'))
                 continue
             else:
-                self.say("Timeout reached. Have a good day.")
+                self.say("Timeout reached. Have a good day.", cache=True)
                 self.agi.hangup()
                 return
 
+    def _runBatch(self, ids):
+        """
+        Walks the contact through every issue in 'ids' that is still open;
+        each one can be played, accepted or rejected in turn. Accepted
+        issues are recorded in the db right away (the queue reads the
+        results once the call has ended).
+        """
+        issues = [x for x in self.sql.fetchIssues(ids) if x.status in (0, 3)]
+        if not issues:
+            self.say("Hello. This is the %s hotline calling. "
+                     "The issues have already been accepted by another contact. Good bye." % self.conf['team_name'], cache=True)
+            self.agi.hangup()
+            return
+
+        self.say("Hello. This is the %s hotline calling. "
+                 "There are %s new trouble issues." % (self.conf['team_name'], len(issues)))
+        accepted = 0
+
+        for (n, issue) in enumerate(issues):
+            self.say("Issue %s of %s has been created by %s" % (n + 1, len(issues), issue.name))
+
+            while True:
+                data = self.prompt("Please press 1 to listen to the message, press 2 to accept the issue or press 3 to reject the issue.|5000|1", cache=True)
+
+                if not data:
+                    self.say("Timeout reached. The remaining issues have been automatically rejected. Good bye.", cache=True)
+                    self.agi.hangup()
+                    return
+
+                if data == '1':
+                    self._playIssue(issue.id, issue.msg_id)
+                    continue
+
+                if data == '2':
+                    if self.sql.acceptIssue(issue.id, self.agi.variable('contact') or None):
+                        self._notifyAccepted()
+                        accepted += 1
+                        self.say("Thank you. The issue has been marked as accepted.", cache=True)
+                    else:
+                        self.say("Sorry, the issue has already been accepted by another contact.", cache=True)
+                    break
+
+                if data == '3':
+                    self.say("The issue has been rejected.", cache=True)
+                    break
+
+        self.say("You have accepted %s of %s issues. Good bye." % (accepted, len(issues)))
+        self.agi.hangup()
+
+    def _playIssue(self, id, msg_id):
+        # The issue's recording, followed by those of any coalesced calls
+        self.playMessage(msg_id)
+        for msg_id in self.sql.fetchRecordings(id):
+            self.playMessage(msg_id)
+
+    def _notifyAccepted(self):
+        """
+        Lets the queue know right away that this call won the issue, so it can
+        hang up the other ringing contacts (see Queue._userEvent).
+        """
+        call_id = self.agi.variable('call_id')
+        if not call_id:
+            return
+
+        try:
+            self.agi.appexec('UserEvent', 'HotlineAccept,CallID: %s' % call_id)
+        except Exception, e:
+            self.log.warning("Unable to send accept event; Exception: %s", e, extra={'call_id' : call_id})
+
 class Queue(_Base):
     """
     This class facilitates calling scheduled/emergency contacts if a new trouble
-    issue has been submitted. The script utilizing this class should be executed
-    via cron.
+    issue has been submitted. The script utilizing this class should either be
+    executed via cron (run()) or started once as a daemon (runDaemon()).
 
     Basic usage:
 
     from pyhotline import Queue
     queue_obj = Queue('/etc/pyhotline.conf', 'myhotline')
     queue_obj.run()
+
+    Daemon usage (keeps the manager session open, picks up new issues as soon
+    as they are inserted, reloads the config when it changes or on SIGHUP and
+    exits on SIGTERM/SIGINT):
+
+    queue_obj = Queue('/etc/pyhotline.conf', 'myhotline')
+    queue_obj.runDaemon()
     """
-    def __init__(self, config_file, group):
-        _Base.__init__(self, config_file, group, use_mgr=True)
-        # Event vars
-        self.action_id  = None
-        self.unique_id  = None
-        self.hangup_event = False
-        self.orig_event   = False
+    def __init__(self, config_file, group, conf=None, session=None):
+        _Base.__init__(self, config_file, group, conf=conf)
+        # In-flight calls, keyed by ActionID and by channel Uniqueid
+        self.calls = {}
+        self.channels = {}
+        self.tokens = {}
+        self.calls_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        # Identifies this runner's claims on issues
+        self.owner = '%s:%s:%s' % (socket.gethostname(), os.getpid(), _Misc.genRandom())
+        self.next_sweep = 0
+        self.next_archive = 0
+        self.next_retention = 0
+        self.daemon = False
+
+        # Due times of issues waiting for their next dispatch round
+        self.retries = _Schedule()
+
+        # Outcomes of finished calls, written to 'call_attempts' after each batch
+        self.call_attempts = []
+
+        # Notification emails go through a spool (see _Mailer)
+        self.mailer = None
+        self._setupMailer()
+
+        # Set by SIGHUP; the daemon reloads the config before its next poll
+        self.reload = threading.Event()
+        self.config_version = self._configVersion()
+
+        # Manager session; shared between queues when run through MultiQueue
+        if session is None:
+            session = _ManagerSession(self.conf, self.log)
+        self.session = session
+        self.session.register('Hangup', self._hangupEvent)
+        self.session.register('OriginateResponse', self._originateEvent)
+        self.session.register('UserEvent', self._userEvent)
+
+        self.roster = _Roster.compile(self.conf['contacts'], self.conf['timezone'])
+
+    def _setupMailer(self):
+        if self.mailer is not None or not self.conf['email_notify']:
+            return
 
-    def _originateEvent(self, event, manager):
-        if event.headers['ActionID'] == self.action_id:
-            #print event.headers['Response']
-            if event.headers['Response'] == 'Success':
-                self.unique_id = event.headers['Uniqueid']
-                self.log.debug("Event >> Originate event succeeded: %s" % event.headers['Uniqueid'])
-            else:
-                self.log.debug("Event >> Originate event failed")
+        spool_dir = self.conf['spool_dir'] or os.path.join(self.conf['message_dir'], 'spool')
+        self.mailer = _Mailer(spool_dir, self.conf['smtp_host'], self.conf['smtp_port'], self.log,
+                              self.conf['attachment_budget'])
+        if self.daemon:
+            self.mailer.start()
 
-            self.orig_event = True
+    def runDaemon(self):
+        """
+        Runs the queue until SIGTERM/SIGINT is received. The database is
+        checked for changes every 'queue_poll_interval' seconds and a queue
+        run is started as soon as it has changed or an issue's retry is due
+        (see _Schedule). The config is reloaded (see reloadConfig) when the
+        config file has changed or on SIGHUP. A lost manager connection is
+        re-established with exponential backoff (1..60 seconds).
+        Has to be called from the main thread (signal handlers).
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._stopHandler)
+        signal.signal(signal.SIGHUP, self._reloadHandler)
 
-    def _hangupEvent(self, event, manager):
-        #print event.headers
-        if event.headers['Uniqueid'] == self.unique_id:
-            self.log.debug("Event >> Hangup event: %s" % self.unique_id)
-            self.hangup_event = True
+        self.log.info("Queue daemon started (poll interval: %ss)", self.conf['queue_poll_interval'])
+        self.startMailer()
+        self.startMetrics()
 
-    def run(self):
-        # Check for new 'unhandled' messages
-        unhandled = self.sql.fetchUnhandled()
-        total_messages = len(unhandled)
-        handled_messages = 0
+        last_version = None
+        dirty = True
 
-        if total_messages < 1:
-            #self.log.debug("No new unhandled issues.")
-            return
+        while not self.stopping.isSet():
+            if self._reloadDue():
+                self.reloadConfig()
 
-        self.log.info("Found %s unhandled issues." % total_messages)
+            version = self._dbVersion()
+            if version != last_version:
+                self._loadRetries()
+            if version != last_version or self._housekeepingDue() or self._retryDue():
+                last_version = version
+                dirty = True
 
-        if not self.managerLogin():
-            return
+            if dirty and self._ensureManager():
+                dirty = False
+                self.run()
 
-        self.mgr.register_event('Hangup', self._hangupEvent)
-        self.mgr.register_event('OriginateResponse', self._originateEvent)
+            self.stopping.wait(self._pollDelay(self.conf['queue_poll_interval']))
 
+        self.session.close()
+        self.log.info("Queue daemon stopped")
 
-        # Get call lists
-        scheduled_contacts = self._getScheduled()
-        skip_list = [contact['name'] for contact in scheduled_contacts]
-        emergency_contacts = self._getEmergency(skip_list)
+    def _stopHandler(self, signum, frame):
+        self.log.info("Received signal %s; finishing in-flight calls and shutting down...", signum)
+        self.stopping.set()
 
-        attempts = 0 
+    def _reloadHandler(self, signum, frame):
+        self.reload.set()
 
-        while True:
-            # If max_attempts = 0 -> infinite loop; otherwise iterate max_attempts
-            if attempts == self.conf['max_attempts'] and self.conf['max_attempts'] != 0:
-                break
+    def _configVersion(self):
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _reloadDue(self):
+        # SIGHUP, or the config file has been changed since it was loaded
+        version = self._configVersion()
+        if not self.reload.isSet() and version == self.config_version:
+            return False
 
-            # Break out of loop if all messages accepted
-            if handled_messages == total_messages:
-                break
-            
-            attempts += 1
-            self.log.info("Queue run attempt %s/%s..." % (attempts, self.conf['max_attempts']))
+        self.reload.clear()
+        self.config_version = version
+        return True
 
-            for msg in unhandled:
-                # Skip accepted issues
-                if msg['employee'] is not None:
-                    self.log.debug("Issue #%s already accepted by '%s'. Skipping..." % (msg['id'], msg['employee']))
-                    continue
+    def reloadConfig(self, conf=None):
+        """
+        Re-reads the group's config (or takes the already validated 'conf')
+        and applies it from the next queue run on: contacts, schedules,
+        timeouts, ring/retry/notification options. The manager connection,
+        db, log and spool settings keep their values until a restart. An
+        invalid config is logged and the current one kept. Returns True/False.
+        """
+        if conf is None:
+            (status, conf) = _Config(self.config_file, self.group).parse(use_cache=False)
+            if not status:
+                self.log.critical("Unable to reload the config; keeping the current one. Error: %s", conf)
+                return False
 
-                (handled_type, contact) = self.handleIssue(msg, scheduled_contacts, emergency_contacts)
+        self.conf = conf
+        self.roster = _Roster.compile(self.conf['contacts'], self.conf['timezone'])
+        self._setupMailer()
+        self.log.info("Config reloaded")
+        return True
 
-                if handled_type:
-                    handled_messages += 1
-                    msg['employee'] = contact['name']
-                    msg['handled_type'] = handled_type 
-                    self.sql.updateStatus(msg['id'], 2, contact['name'])
+    def startMailer(self):
+        """
+        Delivers notification emails from a background thread from now on,
+        instead of at the end of each run() (used by the daemon modes).
+        """
+        self.daemon = True
+        if self.mailer is not None:
+            self.mailer.start()
 
-        # Update the leftover unhandled issues with failed status 
-        unhandled_ids = [x['id'] for x in unhandled if 'handled' not in x]
+    def _dbVersion(self):
+        # PRAGMA data_version only changes on commits made by *other*
+        # connections (ie. Inbound); fall back to the db file's stat info
+        version = self.sql.fetchDataVersion()
+        if version is not None:
+            return version
 
-        for id in unhandled_ids:
-            self.log.debug("Setting issue #%s as unhandled" % (id))
-            self.sql.updateStatus(id, 2)
+        try:
+            st = os.stat(self.conf['sqlite_database'])
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _housekeepingDue(self):
+        # Issues of a crashed runner become claimable (once per lease period),
+        # resolved issues become archivable and recordings expire without
+        # any db change
+        now = _monotonic()
+        if now >= self.next_sweep:
+            self.next_sweep = now + self.conf['claim_lease']
+            return True
 
-        if self.conf['email_notify']:
-            self.log.info("Sending email notification to '%s'..." % (self.conf['email_to']))
-            if not self._notifyEmail(attempts, unhandled, scheduled_contacts, emergency_contacts):
-                self.log.critical("Unable to send notification email through '%s:%s' - check your mail logs!" % (self.conf['smtp_host'], self.conf['smtp_port'])) 
+        if self.conf['archive_after_days'] and now >= self.next_archive:
+            return True
+        if self.conf['message_retention_days'] and now >= self.next_retention:
+            return True
+        return False
 
-        self.log.info("Queue run finished. Stats: %s/%s attempts total, %s/%s issues resolved" % (attempts, self.conf['max_attempts'], handled_messages, total_messages)) 
+    def _ensureManager(self):
+        return self.session.ensure()
 
-    def handleIssue(self, msg, scheduled, emergency):
-        """
-        Issue handling logic - attempt scheduled contacts first, followed by emergency.
-        Returns tuple (string||None handled_type, string||None contact).
-        """
-        # Attempt scheduled contacts
-        self.log.info("Attempting scheduled contacts for issue #%s..." % msg['id'])
+    def _originateEvent(self, event, manager):
+        self.calls_lock.acquire()
+        try:
+            call = self.calls.get(event.headers.get('ActionID'))
+            if call is None:
+                return
 
-        for contact in scheduled:
-            self.log.info("Attempting to call scheduled contact '%s' for issue #%s" % (contact['name'], msg['id']))
-            if self.attemptCall(contact['number'], msg):
-                self.log.info("Primary contact (%s) succeeded for issue #%s." % (contact['name'], msg['id']))
-                return ("scheduled", contact)
+            if event.headers['Response'] == 'Success':
+                call.unique_id = event.headers['Uniqueid']
+                call.channel = event.headers.get('Channel')
+                call.answered_at = _monotonic()
+                self.channels[call.unique_id] = call
+                self.log.debug("Event >> Originate event succeeded: %s", event.headers['Uniqueid'], extra=_Misc.logFields(call=call))
             else:
-                self.log.warning("Primary contact (%s) failed for issue #%s." % (contact['name'], msg['id']))
-        
-        # Attempt emergency contacts
-        self.log.warning("All scheduled contacts failed for issue #%s" % msg['id'])
+                self.log.debug("Event >> Originate event failed: %s", call.action_id, extra=_Misc.logFields(call=call))
 
-        if len(emergency) == 0:
-            self.log.warning("No emergency contacts available for issue #%s" % msg['id'])
-            return (None, None)
+            if call.cancelled:
+                # Another contact won the issue while this one was ringing
+                self._hangupCall(call)
+                self._forgetCall(call)
+                return
 
-        for contact in emergency:
-            self.log.info("Attempting to call emergency contact '%s' for issue #%s" % (contact['name'], msg['id']))
-            if self.attemptCall(contact['number'], msg):
-                self.log.info("Emergency contact (%s) succeeded for issue #%s." % (contact['name'], msg['id']))
-                return ("emergency", contact)
-            else:
-                self.log.warning("Emergency contact (%s) failed for issue #%s." % (contact['name'], msg['id']))
+            call.signal('orig_event')
+        finally:
+            self.calls_lock.release()
 
-        return (None, None)
+    def _hangupEvent(self, event, manager):
+        self.calls_lock.acquire()
+        try:
+            call = self.channels.get(event.headers.get('Uniqueid'))
+            if call is None:
+                return
 
-    def attemptCall(self, number, msg): 
-        """
-        Attempts to make a call to a specified number; if originate & hangup
-        events are completed - checks the database to see whether call was 
-        accepted/rejected or dismissed - returns True/False.
-        """
-        # Reset these, in case this is not our first attemptCall()
-        self.unique_id  = None
-        self.hangup_event = False
-        self.orig_event   = False
+            self.log.debug("Event >> Hangup event: %s", call.unique_id, extra=_Misc.logFields(call=call))
+            call.signal('hangup_event')
+        finally:
+            self.calls_lock.release()
 
-        hangup_timeout = 180
-        spent_time = 1
+    def _userEvent(self, event, manager):
+        # Sent by Outbound as soon as a contact accepts the issue
+        if event.headers.get('UserEvent') != 'HotlineAccept':
+            return
 
-        response = self.call(number, channel_vars = msg)
-        self.action_id = response.headers['ActionID']
+        self.calls_lock.acquire()
+        try:
+            call = self.tokens.get(event.headers.get('CallID'))
+            if call is None:
+                return
 
-        # Wait for originate event
-        self.log.debug("Waiting for originate event for %s seconds" % self.conf['origin_timeout'])
-        while int(spent_time) != self.conf['origin_timeout']:
-            if self.orig_event:
-                if self.unique_id:
-                    # Call completed
-                    self.log.debug("UniqueID '%s' acquired. Moving to next loop. Spent '%s' seconds in wait state" % (self.unique_id, int(spent_time)))
-                    break
-                else:
-                    # Call failed
-                    self.log.debug("Originate failed. Spent '%s' seconds in wait state" % (int(spent_time)))
-                    return False
-            time.sleep(.1)
-            spent_time += .1
+            self.log.debug("Event >> Accept event: %s", call.token, extra=_Misc.logFields(call=call))
+            call.signal('accepted')
+        finally:
+            self.calls_lock.release()
 
-        if int(spent_time) == self.conf['origin_timeout']:
-            # Exceeded timeout for originate
-            self.log.debug("Exceeded timeout for originate... Spent '%s' seconds in wait state" % (int(spent_time)))
-            return False
+    def run(self):
+        """
+        Claims unhandled issues in batches of up to 'claim_batch' and
+        dispatches them, until no claimable issue is left. Claims are leases
+        ('claim_lease' seconds, renewed while the batch is being worked on),
+        so several queue runners can share a db without calling the same
+        issue twice, and the issues of a crashed runner are picked up again
+        once its leases expire.
+        """
+        while not self.stopping.isSet():
+            unhandled = self.sql.claimUnhandled(self.owner, self.conf['claim_lease'], self.conf['claim_batch'])
 
-        spent_time = 1
-        # Wait for hangup event
-        self.log.debug("Waiting for hangup event for %s seconds" % hangup_timeout)
-        while int(spent_time) != hangup_timeout:
-            if self.hangup_event:
-                self.log.debug("Hangup completed. Moving on! Spent '%s' seconds in wait state" % (int(spent_time)))
+            if len(unhandled) < 1:
+                #self.log.debug("No new unhandled issues.")
                 break
-            time.sleep(.1)
-            spent_time += .1
 
-        if int(spent_time) == hangup_timeout:
-            # Exceeded wait for hangup
-            self.log.debug("Exceeded timeout for hangup. Spent '%s' " % (int(spent_time)))
-            return False
+            if not self._runBatch(unhandled):
+                return
 
-        # Hang up ocurred, let's check DB
-        msg_status = self.sql.fetchStatus(msg['id'])
-        if msg_status == 1:
-            return True
+        if self.conf['archive_after_days'] and self._archiveDue():
+            try:
+                self.archive()
+            except Exception, e:
+                self.log.critical("Unable to archive resolved issues; Exception: %s", e)
 
-        # Person was not reachable or did not accept issue
-        return False
+        if self.conf['message_retention_days'] and self._retentionDue():
+            try:
+                self.sweepMessages()
+            except Exception, e:
+                self.log.critical("Unable to remove expired recordings; Exception: %s", e)
 
-    def _notifyEmail(self, attempts, issues, scheduled, emergency):
-        email_body = "Number of issues: %s\n" % len(issues)
-        email_body += "Number of attempts: %s/%s\n" % (attempts, self.conf['max_attempts'])
+        self.exportMetrics()
 
-        if len(scheduled) == 0:
-            sched_str = "None"
-        else:
-            sched_str = ', '.join([contact['name'] for contact in scheduled])
+        # Without a background sender (cron), send what has been spooled -
+        # including emails left over by previous runs - before returning
+        if self.mailer is not None and not self.daemon:
+            try:
+                self.mailer.deliver()
+            except Exception, e:
+                self.log.critical("Unable to deliver notification emails; Exception: %s", e)
 
-        if len(emergency) == 0:
-            emerg_str = "None"
-        else:
-            emerg_str = ', '.join([contact['name'] for contact in emergency])
+    def _runBatch(self, unhandled):
+        """
+        Gives each claimed issue one dispatch round. Issues that were not
+        accepted are handed back with their next attempt due after the
+        retry backoff, or given up on after 'max_attempts' rounds. A round
+        that failed before placing any call is retried without counting.
+        """
+        total_messages = len(unhandled)
 
-        email_body += "Scheduled contacts: %s\n" % sched_str
-        email_body += "Emergency contacts: %s\n" % emerg_str
-        email_body += "\n"
+        self.log.info("Claimed %s unhandled issues.", total_messages)
 
-        files = []
+        if not self._ensureManager():
+            self.sql.releaseClaims(self.owner, [x.id for x in unhandled])
+            return False
 
-        for issue in issues:
-            email_body += "Issue id: %s\n" % issue['id']
-            email_body += "Client Name: %s\n" % issue['name'] 
-            email_body += "Client CallerID: %s\n" % issue['caller_id']
-            email_body += "Client Message ID: %s\n" % issue['msg_id']
+        # Keep the leases alive while the batch is being worked on
+        batch_done = threading.Event()
+        keeper = threading.Thread(target=self._keepLeases, args=([x.id for x in unhandled], batch_done))
+        keeper.setDaemon(True)
+        keeper.start()
+
+        # Get call lists
+        (scheduled_contacts, emergency_contacts) = self.roster.lookup()
 
-            msg_filename = self.conf['message_dir'] + '/' + issue['msg_id'] + '.gsm'
-            files.append(msg_filename)
+        if self.conf['contact_order'] == 'adaptive':
+            (scheduled_contacts, emergency_contacts) = self.orderContacts(scheduled_contacts, emergency_contacts)
 
-            if issue['employee'] is not None: 
-                email_body += "Status: Handled by %s\n\n" % issue['employee']
+        try:
+            if self.conf['batch_calls'] and len(unhandled) > 1:
+                dispatched = self.dispatchBatch(unhandled, scheduled_contacts, emergency_contacts)
             else:
-                email_body += "Status: Unhandled\n\n"
-        
-        email = { 
-            'to' : self.conf['email_to'], 
-            'from' : self.conf['email_from'], 
-            'subject' : "[%s hotline] Issue summary" % self.group,
-            'message' : email_body
-        }
+                dispatched = self.dispatch(unhandled, scheduled_contacts, emergency_contacts)
+        finally:
+            batch_done.set()
 
-        return _Misc.sendEmail(email, files, host=self.conf['smtp_host'], port=self.conf['smtp_port'])
+        # Daemon is shutting down; hand the rest back for the next start (or another runner)
+        self.sql.releaseClaims(self.owner, [x.id for x in unhandled if x not in dispatched])
+        self._flushCallAttempts()
 
-    def _getScheduled(self):
-        weekday = (datetime.datetime.now()).weekday()
-        call_list = []
+        finished = []
+        retries = 0
 
-        for employee in self.conf['contacts']:
-            if weekday in employee['schedule']:
-                call_list.append(employee)
+        for msg in dispatched:
+            # Accepted issues were resolved as soon as they were accepted
+            if msg.employee is not None:
+                finished.append(msg)
+                continue
 
-        # Sort by priority level
-        return sorted(call_list, key = itemgetter('priority'), reverse=True)
+            if msg.error is not None and not msg.calls:
+                # Not a single call went out (ie. the manager rejected the
+                # originate); try again later without counting a round
+                delay = self._retryDelay(msg.attempts + 1)
+                self.log.warning("No call placed for issue #%s; retrying in %s seconds", msg.id, delay, extra=_Misc.logFields(msg))
+                self.sql.releaseClaims(self.owner, [msg.id], int(time.time()) + delay)
+                self.retries.push(time.time() + delay, msg.id)
+                retries += 1
+                continue
 
-    def _getEmergency(self, skip_list=[]):
-        call_list = []
+            msg.attempts += 1
 
-        for employee in self.conf['contacts']:
-            if employee['name'] in skip_list:
+            if self.conf['max_attempts'] != 0 and msg.attempts >= self.conf['max_attempts']:
+                self.log.debug("Setting issue #%s as unhandled after %s attempts", msg.id, msg.attempts, extra=_Misc.logFields(msg))
+                if not self.sql.finishRound(self.owner, msg.id, 2):
+                    if self._finishLate(msg):
+                        finished.append(msg)
+                    continue
+                _metrics.inc('hotline_issues_total', (self.group, 'failed'))
+                _metrics.observe('hotline_issue_attempts', (self.group,), msg.attempts)
+                finished.append(msg)
                 continue
 
-            if employee['emergency']:
-                call_list.append(employee)
+            delay = self._retryDelay(msg.attempts)
+            if not self.sql.finishRound(self.owner, msg.id, 0, next_attempt=int(time.time()) + delay):
+                if self._finishLate(msg):
+                    finished.append(msg)
+                continue
 
-        # Again, sort by priority level
-        return sorted(call_list, key = itemgetter('priority'), reverse=True)
+            self.log.info("Issue #%s not accepted (attempt %s/%s); retrying in %s seconds", msg.id, msg.attempts,
+                          self.conf['max_attempts'], delay, extra=_Misc.logFields(msg))
+            self.retries.push(time.time() + delay, msg.id)
+            retries += 1
 
-class _Misc:
-    """
-    Miscelaneous class functions used by other classes in the module.
-    """
-    @classmethod
-    def getTime(cls):
-        return (datetime.datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+        if self.conf['email_notify'] and finished:
+            self.log.info("Queueing email notification to '%s'...", self.conf['email_to'])
+            if not self._notifyEmail(finished, scheduled_contacts, emergency_contacts):
+                self.log.critical("Unable to queue notification email - check the spool dir!")
 
-    @classmethod
-    def genRandom(cls, length=8):
-        return ''.join([random.choice(string.hexdigits) for n in xrange(8)])
+        self.log.info("Queue run finished. Stats: %s/%s issues resolved, %s given up, %s to be retried",
+                      len([x for x in finished if x.employee is not None]), total_messages,
+                      len([x for x in finished if x.employee is None]), retries)
+        return True
 
-    @classmethod
-    def sendEmail(cls, email, files=[], host='localhost', port=25):
-        """ Expects an email dictionary """
-        req_params = ['to', 'from', 'subject', 'message']
-        if type(email) is not dict:
+    def _finishLate(self, msg):
+        # The round's finishRound() found the issue accepted (by a contact
+        # who answered after the call had been given up on) or no longer
+        # ours; resolve it in the former case. Returns True if resolved.
+        employee = self.sql.fetchEmployee(msg.id)
+        if self.sql.fetchStatus(msg.id) != 1 or not self.sql.finishRound(self.owner, msg.id, 2, employee):
+            self.log.warning("Issue #%s is no longer claimed by this runner; leaving it alone", msg.id, extra=_Misc.logFields(msg))
             return False
 
-        for req in req_params:
-            if req not in email:
-                return False
+        self.log.info("Issue #%s was accepted by '%s' after the call had been given up on", msg.id, employee, extra=_Misc.logFields(msg))
+        msg.employee = employee
+        _metrics.inc('hotline_issues_total', (self.group, 'accepted'))
+        _metrics.observe('hotline_issue_attempts', (self.group,), msg.attempts)
+        return True
 
-        if type(files) is not list or len(files) == 0:
-            return False
+    def orderContacts(self, scheduled, emergency):
+        """
+        Reorders contacts sharing a priority value by their call history
+        (see _contactCost) - the contact most likely to answer quickly is
+        called first. Attempts made around the current hour of day are
+        preferred over a contact's overall history. Returns tuple
+        (scheduled, emergency).
+        """
+        since = int(time.time()) - self.conf['contact_stats_days'] * 86400
+        hour = self.roster.now().hour
 
-        for f in files:
-            if not os.path.exists(f):
-                return False
+        try:
+            stats = self.sql.fetchContactStats(since)
+            nearby = self.sql.fetchContactStats(since, [(hour + x) % 24 for x in (-1, 0, 1)])
+        except sqlite3.Error, e:
+            self.log.warning("Unable to read the contacts' call history; keeping the priority order. Exception: %s", e)
+            return (scheduled, emergency)
+
+        # Too few calls around this hour to tell; go by all of them
+        for (name, entry) in nearby.items():
+            if entry[0] >= 3:
+                stats[name] = entry
+
+        ordered = []
+        for contacts in (scheduled, emergency):
+            # Stable sort - without history contacts keep their config order
+            result = tuple(sorted(contacts, key = lambda contact: (-contact.priority, self._contactCost(stats.get(contact.name)))))
+            if result != tuple(contacts):
+                self.log.debug("Contact order by call history: %s", ', '.join([x.name for x in result]))
+            ordered.append(result)
+
+        return tuple(ordered)
+
+    def _contactCost(self, entry):
+        # Expected seconds spent calling a contact per answered call: the
+        # answer rate (smoothed, unknown contacts count as 50%) weighs the
+        # average ring time of answered calls against that of unanswered
+        # ones ('origin_timeout' and half of it without history)
+        timeout = float(self.conf['origin_timeout'])
+        (attempts, answered, answer_ms, miss_ms) = entry or (0, 0, None, None)
+
+        rate = (answered + 1.0) / (attempts + 2.0)
+        answer_time = answer_ms is not None and answer_ms / 1000.0 or timeout / 2
+        miss_time = miss_ms is not None and miss_ms / 1000.0 or timeout
+        return (rate * answer_time + (1 - rate) * miss_time) / rate
+
+    def _flushCallAttempts(self):
+        self.calls_lock.acquire()
+        try:
+            (attempts, self.call_attempts) = (self.call_attempts, [])
+        finally:
+            self.calls_lock.release()
 
-        # Borrowed from somewhere on stackoverflow
-        msg = MIMEMultipart()
-        msg['From'] = email['from']
-        msg['To'] = email['to']
-        msg['Date'] = formatdate(localtime=True)
-        msg['Subject'] = email['subject']
+        if not attempts:
+            return
 
-        msg.attach( MIMEText(email['message']))
+        try:
+            self.sql.recordCallAttempts(attempts, int(time.time()) - self.conf['contact_stats_days'] * 86400)
+        except sqlite3.Error, e:
+            self.log.warning("Unable to record %s call attempts; Exception: %s", len(attempts), e)
+
+    def _retryDelay(self, attempts):
+        # 'retry_interval' after the first round, doubling with every further one
+        return min(self.conf['retry_interval'] * 2 ** min(attempts - 1, 16), self.conf['retry_interval_max'])
+
+    def _retryDue(self):
+        # Woken up by the retry schedule instead of polling the db for due issues
+        return len(self.retries.popDue(time.time())) > 0
+
+    def _pollDelay(self, interval):
+        # Sleep no longer than until the next retry is due
+        due = self.retries.nextDue()
+        if due is None:
+            return interval
+        return max(min(interval, due - time.time()), 0)
+
+    def _loadRetries(self):
+        # Retries scheduled by earlier (or other) runners
+        self.retries = _Schedule(self.sql.fetchRetries())
+
+    def archive(self):
+        """
+        Moves issues resolved more than 'archive_after_days' ago out of the
+        'messages' table (see _SQL.archiveResolved) in batches of
+        'archive_batch' rows, then returns freed pages to the file system.
+        Returns the number of archived issues.
+        """
+        if not self.conf['archive_after_days']:
+            return 0
 
-        for f in files:
-            part = MIMEBase('application', "octet-stream")
-            part.set_payload(open(f,"rb").read())
-            Encoders.encode_base64(part)
-            part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(f))
-            msg.attach(part)
+        before = (datetime.datetime.now() - datetime.timedelta(days=self.conf['archive_after_days'])).strftime('%Y-%m-%d %H:%M:%S')
+        total = 0
 
-        try:
-            s = smtplib.SMTP(host, port)
-            s.sendmail(email['from'], [email['to']], msg.as_string())
-            s.quit()
-        except Exception, e:
+        while not self.stopping.isSet():
+            moved = self.sql.archiveResolved(before, self.conf['archive_batch'], self.conf['archive_database'])
+            total += moved
+            if moved < self.conf['archive_batch']:
+                break
+
+        if total:
+            self.log.info("Archived %s resolved issues older than %s days", total, self.conf['archive_after_days'])
+            self.sql.incrementalVacuum()
+
+        return total
+
+    def sweepMessages(self):
+        """
+        Removes recordings older than 'message_retention_days' from the
+        message store, except those of issues that are still open. Returns
+        the number of removed recordings.
+        """
+        if not self.conf['message_retention_days']:
+            return 0
+
+        before = time.time() - self.conf['message_retention_days'] * 86400
+        removed = self.store.sweep(before, self.sql.fetchOpenMsgIds())
+
+        if removed:
+            self.log.info("Removed %s recordings older than %s days", removed, self.conf['message_retention_days'])
+        return removed
+
+    def _retentionDue(self):
+        # At most once a day (once per run when started from cron)
+        if _monotonic() < self.next_retention:
+            return False
+
+        self.next_retention = _monotonic() + 86400
+        return True
+
+    def _archiveDue(self):
+        # At most once an hour (once per run when started from cron)
+        if _monotonic() < self.next_archive:
             return False
 
+        self.next_archive = _monotonic() + 3600
         return True
 
+    def _keepLeases(self, ids, done):
+        interval = max(self.conf['claim_lease'] / 3.0, 1)
+
+        while True:
+            done.wait(interval)
+            if done.isSet():
+                return
+
+            try:
+                self.sql.renewClaims(self.owner, ids, self.conf['claim_lease'])
+            except Exception, e:
+                self.log.critical("Unable to renew issue leases; Exception: %s", e)
+
+    def dispatch(self, issues, scheduled, emergency):
+        """
+        Handles every issue in 'issues', keeping up to 'max_concurrent_calls'
+        of them in flight at once. Returns the attempted issues (all of them,
+        unless the daemon is shutting down) once they are done; accepted
+        issues get their 'employee', 'handled_type' and 'attempts' set.
+        """
+        slots = threading.BoundedSemaphore(self.conf['max_concurrent_calls'])
+        workers = []
+
+        for msg in issues:
+            slots.acquire()
+            if self.stopping.isSet():
+                slots.release()
+                break
+
+            worker = threading.Thread(target=self._dispatchIssue, args=(msg, scheduled, emergency, slots))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append((msg, worker))
+
+        for (msg, worker) in workers:
+            worker.join()
+
+        return [msg for (msg, worker) in workers]
+
+    def _dispatchIssue(self, msg, scheduled, emergency, slots):
+        try:
+            try:
+                (handled_type, contact) = self.handleIssue(msg, scheduled, emergency)
+            except Exception, e:
+                self.log.critical("Unable to handle issue #%s; Exception: %s", msg.id, e, extra=_Misc.logFields(msg))
+                msg.error = e
+                return
+
+            if handled_type:
+                self._resolveIssue(msg, contact, handled_type)
+        finally:
+            slots.release()
+
+    def _resolveIssue(self, msg, contact, handled_type):
+        msg.employee = contact.name
+        msg.handled_type = handled_type 
+        msg.attempts += 1
+        if not self.sql.finishRound(self.owner, msg.id, 2, contact.name):
+            # Still accepted by the contact; another runner re-claimed it
+            # after the lease had run out and resolves it
+            self.log.warning("Issue #%s is no longer claimed by this runner; leaving it alone", msg.id, extra=_Misc.logFields(msg, contact))
+            return
+
+        _metrics.inc('hotline_issues_total', (self.group, 'accepted'))
+        _metrics.observe('hotline_issue_attempts', (self.group,), msg.attempts)
+        created = _Misc.timestamp(msg.date)
+        if created is not None:
+            _metrics.observe('hotline_issue_ack_seconds', (self.group,), max(time.time() - created, 0))
+
+    def dispatchBatch(self, issues, scheduled, emergency):
+        """
+        Presents all of 'issues' to one contact at a time in a single call
+        (see Outbound's batch mode): scheduled contacts first, then
+        emergency contacts, each called about the issues nobody has accepted
+        yet. Returns the attempted issues (all of them, unless the daemon is
+        shutting down), like dispatch().
+        """
+        pending = list(issues)
+        called = False
+
+        for (contacts, handled_type) in ((scheduled, 'scheduled'), (emergency, 'emergency')):
+            for contact in contacts:
+                if not pending or self.stopping.isSet():
+                    break
+
+                self.log.info("Attempting to call %s contact '%s' for %s issues", handled_type, contact.name, len(pending), extra=_Misc.logFields(contact=contact))
+                try:
+                    accepted = self.attemptBatch(contact, pending)
+                except Exception, e:
+                    self.log.critical("Unable to call contact '%s'; Exception: %s", contact.name, e, extra=_Misc.logFields(contact=contact))
+                    for msg in pending:
+                        msg.error = e
+                    continue
+                called = True
+
+                for msg in pending:
+                    if msg.id in accepted:
+                        self.log.info("Issue #%s accepted by %s contact (%s).", msg.id, handled_type, contact.name, extra=_Misc.logFields(msg, contact))
+                        self._resolveIssue(msg, contact, handled_type)
+                    else:
+                        self.log.info("Issue #%s not accepted by %s contact (%s).", msg.id, handled_type, contact.name, extra=_Misc.logFields(msg, contact))
+
+                pending = [x for x in pending if x.employee is None]
+
+        # Without any contact to call (or if every call failed) the issues
+        # still count as attempted and go through the retry backoff; only a
+        # shutdown before the first call hands them back
+        if not called and self.stopping.isSet():
+            return []
+        return issues
+
+    def handleIssue(self, msg, scheduled, emergency):
+        """
+        Issue handling logic - attempt scheduled contacts first, followed by emergency.
+        Returns tuple (string||None handled_type, string||None contact).
+        """
+        # Attempt scheduled contacts
+        self.log.info("Attempting scheduled contacts for issue #%s...", msg.id, extra=_Misc.logFields(msg))
+
+        contact = self._ringContacts(msg, scheduled, 'scheduled')
+        if contact:
+            return ("scheduled", contact)
+        
+        # Attempt emergency contacts
+        self.log.warning("All scheduled contacts failed for issue #%s", msg.id, extra=_Misc.logFields(msg))
+
+        if len(emergency) == 0:
+            self.log.warning("No emergency contacts available for issue #%s", msg.id, extra=_Misc.logFields(msg))
+            return (None, None)
+
+        contact = self._ringContacts(msg, emergency, 'emergency')
+        if contact:
+            return ("emergency", contact)
+
+        return (None, None)
+
+    def _ringContacts(self, msg, contacts, handled_type):
+        """
+        Calls 'contacts' according to the group's 'ring_strategy':
+            sequential - one after another
+            parallel   - all contacts sharing a priority value at once
+            staggered  - one more contact every 'ring_stagger' seconds
+        Returns the contact that accepted the issue or None.
+        """
+        label = {'scheduled' : 'Primary', 'emergency' : 'Emergency'}[handled_type]
+        strategy = self.conf['ring_strategy']
+
+        if strategy == 'sequential':
+            for contact in contacts:
+                self.log.info("Attempting to call %s contact '%s' for issue #%s", handled_type, contact.name, msg.id, extra=_Misc.logFields(msg, contact))
+                if self.attemptCall(contact.number, msg, contact):
+                    self.log.info("%s contact (%s) succeeded for issue #%s.", label, contact.name, msg.id, extra=_Misc.logFields(msg, contact))
+                    return contact
+                else:
+                    self.log.warning("%s contact (%s) failed for issue #%s.", label, contact.name, msg.id, extra=_Misc.logFields(msg, contact))
+            return None
+
+        if strategy == 'staggered':
+            tiers = [contacts]
+            stagger = self.conf['ring_stagger']
+        else:
+            # Contacts are sorted by priority; split them into tiers
+            tiers = []
+            for contact in contacts:
+                if tiers and tiers[-1][0].priority == contact.priority:
+                    tiers[-1].append(contact)
+                else:
+                    tiers.append([contact])
+            stagger = 0
+
+        for tier in tiers:
+            contact = self.ringTier(msg, tier, stagger)
+            if contact:
+                self.log.info("%s contact (%s) succeeded for issue #%s.", label, contact.name, msg.id, extra=_Misc.logFields(msg, contact))
+                return contact
+            self.log.warning("%s contacts (%s) failed for issue #%s.", label, ', '.join([x.name for x in tier]), msg.id, extra=_Misc.logFields(msg))
+
+        return None
+
+    def ringTier(self, msg, contacts, stagger=0):
+        """
+        Rings all of 'contacts' at once, or starts one more of them every
+        'stagger' seconds. The first contact to accept the issue wins and
+        the calls to the others are hung up. Returns the accepting contact
+        or None once every call has failed, been rejected or timed out.
+        """
+        cond = threading.Condition()
+        pending = list(contacts)
+        legs = []
+        winner = None
+        next_start = _monotonic()
+
+        cond.acquire()
+        try:
+            while True:
+                # Start the next leg(s)
+                while pending and _monotonic() >= next_start:
+                    contact = pending.pop(0)
+                    self.log.info("Attempting to call contact '%s' for issue #%s", contact.name, msg.id, extra=_Misc.logFields(msg, contact))
+
+                    # _originateCall takes calls_lock, which the event
+                    # handlers hold while signalling 'cond'; never hold
+                    # both in the opposite order
+                    cond.release()
+                    try:
+                        leg = self._originateCall(contact.number, msg, contact, cond)
+                    finally:
+                        cond.acquire()
+                    legs.append(leg)
+                    next_start = _monotonic() + stagger
+
+                winner = self._ringWinner(msg, legs)
+                if winner is not None:
+                    break
+
+                now = _monotonic()
+                deadlines = []
+                for leg in legs:
+                    # Failed/hung up legs have nothing left to wait for
+                    if leg.done():
+                        continue
+                    deadline = leg.deadline(self.conf['origin_timeout'], self.conf['hangup_timeout'])
+                    if deadline is not None and deadline > now:
+                        deadlines.append(deadline)
+
+                if not deadlines and not pending:
+                    break
+
+                if pending:
+                    deadlines.append(next_start)
+
+                state = [leg.state() for leg in legs]
+                _waitCondition(cond, lambda: [leg.state() for leg in legs] != state, min(deadlines) - _monotonic())
+        finally:
+            cond.release()
+            self._cancelLegs(legs, winner)
+
+        if winner is None:
+            return None
+        return winner.contact
+
+    def _ringWinner(self, msg, legs):
+        for leg in legs:
+            if leg.accepted:
+                return leg
+
+        # Accept events require UserEvent support; fall back to the db
+        # whenever one of the legs has hung up
+        if [leg for leg in legs if leg.hangup_event] and self.sql.fetchStatus(msg.id) == 1:
+            employee = self.sql.fetchEmployee(msg.id)
+            for leg in legs:
+                if leg.contact.name == employee:
+                    return leg
+
+        return None
+
+    def _cancelLegs(self, legs, winner):
+        self.calls_lock.acquire()
+        try:
+            for leg in legs:
+                if leg is winner or leg.done():
+                    # The winner stays on the line to listen to the message
+                    if leg is winner:
+                        leg.accepted = True
+                    self._forgetCall(leg)
+                elif leg.orig_event:
+                    self.log.debug("Hanging up call to '%s' for issue #%s", leg.contact.name, leg.msg.id, extra=_Misc.logFields(call=leg))
+                    self._hangupCall(leg)
+                    leg.cancelled = True
+                    self._forgetCall(leg)
+                else:
+                    # Still ringing; hung up as soon as its originate completes
+                    leg.cancelled = True
+        finally:
+            self.calls_lock.release()
+
+    def _hangupCall(self, call):
+        # Expects calls_lock to be held
+        if not call.channel:
+            return
+
+        try:
+            self.session.hangup(call.channel)
+        except Exception, e:
+            self.log.warning("Unable to hang up channel '%s'; Exception: %s", call.channel, e, extra=_Misc.logFields(call=call))
+
+    def attemptBatch(self, contact, issues):
+        """
+        Calls 'contact' once about all of 'issues' and returns the ids of
+        the issues the contact accepted. The call may take up to
+        'hangup_timeout' seconds per issue.
+        """
+        ids = [x.id for x in issues]
+        call = self._originateCall(contact.number, issues[0], contact, batch=issues)
+
+        try:
+            self._waitCall(call, self.conf['hangup_timeout'] * len(ids))
+            accepted = self.sql.fetchAccepted(ids, contact.name)
+            call.accepted = len(accepted) > 0
+            return accepted
+        finally:
+            self.calls_lock.acquire()
+            try:
+                self._forgetCall(call)
+            finally:
+                self.calls_lock.release()
+
+    def attemptCall(self, number, msg, contact=None): 
+        """
+        Attempts to make a call to a specified number; if originate & hangup
+        events are completed - checks the database to see whether call was 
+        accepted/rejected or dismissed - returns True/False.
+        """
+        call = self._originateCall(number, msg, contact)
+
+        try:
+            call.accepted = self._waitCall(call)
+            return call.accepted
+        finally:
+            self.calls_lock.acquire()
+            try:
+                self._forgetCall(call)
+            finally:
+                self.calls_lock.release()
+
+    def call(self, number, channel_vars={}):
+        """
+        We utilize async=True, as we need to catch the OriginateResponse event,
+        which contains the Uniqueid used for identifying the associated hangup
+        event. Maybe there is a cleaner way to acquire Uniqueid? 
+        """
+        prepend = ''
+        if self.conf['outbound_prepend']:
+            prepend = str(self.conf['outbound_prepend'])
+
+        out_channel = 'Local/' + prepend + number + '@' + self.conf['outbound_context']
+
+        response = self.session.originate(channel   = out_channel,
+                                          exten     = 's', 
+                                          context   = self.group,
+                                          priority  = '1', 
+                                          timeout   = self.conf['origin_timeout'] * 1000, 
+                                          caller_id = self.conf['caller_id'], 
+                                          async     = True,
+                                          variables = channel_vars)
+        return response
+
+    def _originateCall(self, number, msg, contact=None, cond=None, batch=None):
+        call = _Call(number, msg, contact, cond)
+
+        channel_vars = msg.channelVars()
+        channel_vars['call_id'] = call.token
+        if batch:
+            # Outbound's batch mode; not ',' - Asterisk splits variables on it
+            channel_vars['id'] = ':'.join([str(x.id) for x in batch])
+        if contact is not None:
+            channel_vars['contact'] = contact.name
+
+        # Register the call before the event thread can see its OriginateResponse
+        self.calls_lock.acquire()
+        try:
+            response = self.call(number, channel_vars = channel_vars)
+            call.action_id = response.headers['ActionID']
+            call.started = _monotonic()
+            self.calls[call.action_id] = call
+            self.tokens[call.token] = call
+        finally:
+            self.calls_lock.release()
+
+        # Only rounds that placed a call count as an attempt (see _runBatch)
+        for issue in batch or [msg]:
+            issue.calls = (issue.calls or 0) + 1
+
+        return call
+
+    def _waitCall(self, call, hangup_timeout=None):
+        origin_timeout = self.conf['origin_timeout']
+        if hangup_timeout is None:
+            hangup_timeout = self.conf['hangup_timeout']
+        fields = _Misc.logFields(call=call)
+
+        # Wait for originate event
+        self.log.debug("Waiting for originate event for %s seconds (ActionID '%s')", origin_timeout, call.action_id, extra=fields)
+        start = _monotonic()
+
+        if not call.wait('orig_event', origin_timeout):
+            # Exceeded timeout for originate
+            self.log.debug("Exceeded timeout for originate... Spent '%.3f' seconds in wait state", _monotonic() - start, extra=fields)
+            return False
+
+        if not call.unique_id:
+            # Call failed
+            self.log.debug("Originate failed. Spent '%.3f' seconds in wait state", _monotonic() - start, extra=fields)
+            return False
+
+        # Call completed
+        self.log.debug("UniqueID '%s' acquired. Moving to next wait. Spent '%.3f' seconds in wait state", call.unique_id, _monotonic() - start, extra=fields)
+
+        # Wait for hangup event
+        self.log.debug("Waiting for hangup event for %s seconds", hangup_timeout, extra=fields)
+        start = _monotonic()
+
+        if not call.wait('hangup_event', hangup_timeout):
+            # Exceeded wait for hangup
+            self.log.debug("Exceeded timeout for hangup. Spent '%.3f' seconds in wait state", _monotonic() - start, extra=fields)
+            return False
+
+        self.log.debug("Hangup completed. Moving on! Spent '%.3f' seconds in wait state", _monotonic() - start, extra=fields)
+
+        # Hang up ocurred, let's check DB
+        msg_status = self.sql.fetchStatus(call.msg.id)
+        if msg_status == 1:
+            return True
+
+        # Person was not reachable or did not accept issue
+        return False
+
+    def _forgetCall(self, call):
+        # Expects calls_lock to be held
+        if self.calls.pop(call.action_id, None) is not None:
+            self._recordCall(call)
+        self.channels.pop(call.unique_id, None)
+        self.tokens.pop(call.token, None)
+
+    def _recordCall(self, call):
+        contact = call.contact and call.contact.name or call.number
+
+        if call.orig_event:
+            _metrics.observe('hotline_originate_seconds', (self.group, contact, call.unique_id and 'answered' or 'failed'),
+                             call.signalled['orig_event'] - call.started)
+
+        if call.answered_at is not None:
+            if call.hangup_event:
+                _metrics.observe('hotline_call_seconds', (self.group, contact), call.signalled['hangup_event'] - call.answered_at)
+            if 'accepted' in call.signalled:
+                _metrics.observe('hotline_accept_seconds', (self.group, contact), call.signalled['accepted'] - call.answered_at)
+
+        if call.accepted:
+            result = 'accepted'
+        elif call.cancelled:
+            result = 'cancelled'
+        elif call.orig_event and not call.unique_id:
+            result = 'failed'
+        elif not call.hangup_event:
+            result = 'timeout'
+        else:
+            result = 'rejected'
+        _metrics.inc('hotline_calls_total', (self.group, contact, result))
+
+        # Call history for the 'adaptive' contact order; a call hung up
+        # while still ringing tells nothing about the contact
+        if call.contact is None or (call.cancelled and call.answered_at is None):
+            return
+
+        if call.answered_at is not None:
+            ring_time = call.answered_at - call.started
+        elif call.orig_event:
+            ring_time = call.signalled['orig_event'] - call.started
+        else:
+            ring_time = self.conf['origin_timeout']
+
+        self.call_attempts.append((call.contact.name, call.msg.id, int(time.time()), self.roster.now().hour,
+                                   int(call.answered_at is not None), int(ring_time * 1000), int(bool(call.accepted))))
+
+    def exportMetrics(self):
+        """ Writes the metrics to 'metrics_textfile' (if set) """
+        if not self.conf['metrics_textfile']:
+            return
+
+        try:
+            _metrics.loadTextfile(self.conf['metrics_textfile'])
+            _metrics.writeTextfile(self.conf['metrics_textfile'])
+        except (IOError, OSError, ValueError), e:
+            self.log.warning("Unable to write metrics to '%s'; Exception: %s", self.conf['metrics_textfile'], e)
+
+    def startMetrics(self):
+        """ Serves the metrics on 'metrics_port' (if set) """
+        if not self.conf['metrics_port']:
+            return
+
+        try:
+            _metrics.serve(self.conf['metrics_host'], self.conf['metrics_port'])
+        except socket.error, e:
+            self.log.critical("Unable to serve metrics on '%s:%s'; Exception: %s", self.conf['metrics_host'], self.conf['metrics_port'], e)
+
+    def _notifyEmail(self, issues, scheduled, emergency):
+        email_body = "Number of issues: %s\n" % len(issues)
+
+        if len(scheduled) == 0:
+            sched_str = "None"
+        else:
+            sched_str = ', '.join([contact.name for contact in scheduled])
+
+        if len(emergency) == 0:
+            emerg_str = "None"
+        else:
+            emerg_str = ', '.join([contact.name for contact in emergency])
+
+        email_body += "Scheduled contacts: %s\n" % sched_str
+        email_body += "Emergency contacts: %s\n" % emerg_str
+        email_body += "\n"
+
+        files = []
+
+        for issue in issues:
+            email_body += "Issue id: %s\n" % issue.id
+            email_body += "Client Name: %s\n" % issue.name 
+            email_body += "Client CallerID: %s\n" % issue.caller_id
+            email_body += "Client Message ID: %s\n" % issue.msg_id
+            email_body += "Attempts: %s/%s\n" % (issue.attempts, self.conf['max_attempts'])
+
+            files.append(self.store.recording(issue.msg_id))
+
+            # Later calls coalesced into this issue
+            recordings = self.sql.fetchRecordings(issue.id)
+            if recordings:
+                email_body += "Further calls: %s (Message IDs: %s)\n" % (len(recordings), ', '.join(recordings))
+                files.extend([self.store.recording(msg_id) for msg_id in recordings])
+
+            if issue.employee is not None: 
+                email_body += "Status: Handled by %s\n\n" % issue.employee
+            else:
+                email_body += "Status: Unhandled\n\n"
+        
+        email = { 
+            'to' : self.conf['email_to'], 
+            'from' : self.conf['email_from'], 
+            'subject' : "[%s hotline] Issue summary" % self.group,
+            'message' : email_body
+        }
+
+        return self.mailer.enqueue(email, files)
+
+class _Schedule:
+    """
+    Min-heap of (due time, key) entries, so the queue daemon knows when
+    the next retry is due without asking the db. Obsolete entries (ie. the
+    issue got accepted through another runner) are not removed; they only
+    cost a queue run that has nothing to claim.
+    """
+    def __init__(self, entries=()):
+        self.heap = list(entries)
+        heapq.heapify(self.heap)
+        self.lock = threading.Lock()
+
+    def push(self, due, key):
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap, (due, key))
+        finally:
+            self.lock.release()
+
+    def nextDue(self):
+        """ Returns the due time of the earliest entry or None """
+        self.lock.acquire()
+        try:
+            if not self.heap:
+                return None
+            return self.heap[0][0]
+        finally:
+            self.lock.release()
+
+    def popDue(self, now):
+        """ Removes and returns the keys of all entries due by 'now' """
+        due = []
+        self.lock.acquire()
+        try:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[1])
+        finally:
+            self.lock.release()
+        return due
+
+class _Roster:
+    """
+    Compiled on-call roster of a group. Every minute of the week (in the
+    group's timezone) maps to a precomputed tuple of (scheduled, emergency)
+    call lists, each sorted by priority, so "who is on call now" is a single
+    list index. Rosters are compiled once per distinct contacts/timezone
+    combination and cached for the lifetime of the process.
+
+    A contact's 'schedule' holds whole weekdays (0 = Monday) and/or time
+    windows such as {"day": 0, "from": "22:00", "to": "06:00"}; windows
+    ending before they start run into the next day.
+    """
+    week = 7 * 24 * 60
+    cache = {}
+
+    def __init__(self, contacts, timezone=False):
+        self.tz = None
+        if timezone:
+            self.tz = pytz.timezone(timezone)
+
+        contacts = [_Contact.fromDict(contact) for contact in contacts]
+        windows = []
+        boundaries = set([0, self.week])
+
+        for idx, contact in enumerate(contacts):
+            for entry in contact.schedule:
+                for (start, end) in self.windows(entry):
+                    windows.append((idx, start, end))
+                    boundaries.add(start)
+                    boundaries.add(end)
+
+        boundaries = sorted(boundaries)
+        self.slots = [None] * self.week
+
+        # Call lists only change at window boundaries; compute them once per
+        # segment and share them between all of the segment's minutes
+        for (lo, hi) in zip(boundaries[:-1], boundaries[1:]):
+            on_call = set([idx for (idx, start, end) in windows if start <= lo < end])
+
+            scheduled = [contact for (idx, contact) in enumerate(contacts) if idx in on_call]
+            names = set([contact.name for contact in scheduled])
+            emergency = [contact for contact in contacts if contact.emergency and contact.name not in names]
+
+            entry = (tuple(sorted(scheduled, key = attrgetter('priority'), reverse=True)),
+                     tuple(sorted(emergency, key = attrgetter('priority'), reverse=True)))
+            self.slots[lo:hi] = [entry] * (hi - lo)
+
+    @classmethod
+    def compile(cls, contacts, timezone=False):
+        key = json.dumps([contacts, timezone], sort_keys=True)
+        if key not in cls.cache:
+            cls.cache[key] = _Roster(contacts, timezone)
+        return cls.cache[key]
+
+    @classmethod
+    def windows(cls, entry):
+        """ Returns the (start, end) minute-of-week ranges for a schedule entry """
+        if type(entry) != dict:
+            return [(entry * 1440, (entry + 1) * 1440)]
+
+        start = entry['day'] * 1440 + cls.parseTime(entry['from'])
+        end = entry['day'] * 1440 + cls.parseTime(entry['to'])
+        if end <= start:
+            end += 1440
+
+        if end > cls.week:
+            return [(start, cls.week), (0, end - cls.week)]
+        return [(start, end)]
+
+    @classmethod
+    def parseTime(cls, value):
+        """ 'HH:MM' -> minutes since midnight; raises ValueError """
+        (hours, minutes) = value.split(':')
+        (hours, minutes) = (int(hours), int(minutes))
+        if hours < 0 or minutes < 0 or minutes > 59 or hours * 60 + minutes > 1440:
+            raise ValueError("Invalid time '%s'" % value)
+        return hours * 60 + minutes
+
+    def now(self):
+        if self.tz is None:
+            return datetime.datetime.now()
+        return datetime.datetime.now(self.tz)
+
+    def lookup(self, now=None):
+        """ Returns tuple (scheduled, emergency) for 'now' (default: current time) """
+        if now is None:
+            now = self.now()
+        return self.slots[now.weekday() * 1440 + now.hour * 60 + now.minute]
+
+class MultiQueue:
+    """
+    This class runs the queue of every hotline group defined in the config
+    (or of the given subset) from a single process. The config is parsed
+    once (and again when the daemon reloads it) and all groups share one
+    manager connection; each group with new issues is dispatched in its own
+    thread, so one group's ringing calls never hold up another group.
+
+    Basic usage (cron):
+
+    from pyhotline import MultiQueue
+    multi_obj = MultiQueue('/etc/pyhotline.conf')
+    multi_obj.run()
+
+    Daemon usage:
+
+    multi_obj = MultiQueue('/etc/pyhotline.conf')
+    multi_obj.runDaemon()
+    """
+    def __init__(self, config_file, groups=None):
+        self.config_file = config_file
+
+        config = _Config(self.config_file, None)
+        (status, confs) = config.parseAll(groups)
+
+        if not status:
+            print "[ConfigError] %s" % confs
+            sys.exit(1)
+
+        self.stopping = threading.Event()
+        self.reload = threading.Event()
+        self.config_version = None
+        self.pending = {}
+        self.queues = []
+        self.session = None
+
+        for group in sorted(confs.keys()):
+            queue = Queue(self.config_file, group, conf=confs[group], session=self.session)
+            queue.stopping = self.stopping
+            self.session = queue.session
+            self.queues.append(queue)
+
+        self.log = self.queues[0].log
+        self.config_version = self.queues[0].config_version
+        self.workers = {}
+
+    def run(self):
+        """ Performs a single queue run for every group """
+        for queue in self.queues:
+            self._startQueue(queue)
+
+        self._joinWorkers()
+
+    def runDaemon(self):
+        """
+        Same as Queue.runDaemon(), for every group: each group's database is
+        polled for changes and a changed group gets a queue run, unless one is
+        already in progress. A reloaded config applies to each group from its
+        next run on; groups cannot be added or removed without a restart.
+        Has to be called from the main thread.
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._stopHandler)
+        signal.signal(signal.SIGHUP, self._reloadHandler)
+
+        interval = min([queue.conf['queue_poll_interval'] for queue in self.queues])
+        self.log.info("Queue daemon started for %s groups (poll interval: %ss)", len(self.queues), interval)
+        for queue in self.queues:
+            queue.startMailer()
+        self.queues[0].startMetrics()
+
+        versions = {}
+        dirty = set([queue.group for queue in self.queues])
+
+        while not self.stopping.isSet():
+            if self._reloadDue():
+                self._reloadConfig()
+
+            for queue in self.queues:
+                version = queue._dbVersion()
+                if version != versions.get(queue.group):
+                    queue._loadRetries()
+                if version != versions.get(queue.group) or queue._housekeepingDue() or queue._retryDue():
+                    versions[queue.group] = version
+                    dirty.add(queue.group)
+
+            if dirty and self.session.ensure():
+                for queue in self.queues:
+                    if queue.group in dirty and self._startQueue(queue):
+                        dirty.discard(queue.group)
+
+            self.stopping.wait(min([queue._pollDelay(interval) for queue in self.queues]))
+
+        self._joinWorkers()
+        self.session.close()
+        self.log.info("Queue daemon stopped")
+
+    def _reloadHandler(self, signum, frame):
+        self.reload.set()
+
+    def _reloadDue(self):
+        version = self.queues[0]._configVersion()
+        if not self.reload.isSet() and version == self.config_version:
+            return False
+
+        self.reload.clear()
+        self.config_version = version
+        return True
+
+    def _reloadConfig(self):
+        # Applied by _startQueue; a running group keeps its config until
+        # its run has finished
+        (status, confs) = _Config(self.config_file, None).parseAll([queue.group for queue in self.queues])
+        if not status:
+            self.log.critical("Unable to reload the config; keeping the current one. Error: %s", confs)
+            return
+
+        self.pending.update(confs)
+
+    def _startQueue(self, queue):
+        # Returns False if the group's previous run is still in progress
+        worker = self.workers.get(queue.group)
+        if worker is not None and worker.isAlive():
+            return False
+
+        if queue.group in self.pending:
+            queue.reloadConfig(self.pending.pop(queue.group))
+
+        worker = threading.Thread(target=self._runQueue, args=(queue,))
+        worker.setDaemon(True)
+        worker.start()
+        self.workers[queue.group] = worker
+        return True
+
+    def _runQueue(self, queue):
+        try:
+            queue.run()
+        except Exception, e:
+            queue.log.critical("Queue run failed; Exception: %s", e)
+
+    def _joinWorkers(self):
+        for worker in self.workers.values():
+            worker.join()
+
+    def _stopHandler(self, signum, frame):
+        self.log.info("Received signal %s; finishing in-flight calls and shutting down...", signum)
+        self.stopping.set()
+
+class FastAGIServer:
+    """
+    This class runs a FastAGI server that hosts the Inbound and Outbound
+    sessions of every hotline group in one warm process, so a call no longer
+    pays for starting an interpreter, importing modules and validating the
+    config. Each session runs in a child forked off the server (pyst's AGI
+    installs a SIGHUP handler, which only works in a process' main thread),
+    up to 'fastagi_max_children' at once.
+
+    Requests are routed by their path - agi://host[:port]/<group>/<inbound|outbound>.
+    Sessions read their config through the config cache, so changes to the
+    config file are picked up without restarting the server.
+
+    Example Asterisk configuration:
+
+    1234 => {
+        Answer();
+        AGI(agi://127.0.0.1/myhotline/inbound);
+    }
+
+    context myhotline {
+        s => {
+            Answer();
+            AGI(agi://127.0.0.1/myhotline/outbound);
+        }
+    }
+
+    Basic usage (stops on SIGTERM/SIGINT):
+
+    from pyhotline import FastAGIServer
+    server_obj = FastAGIServer('/etc/pyhotline.conf')
+    server_obj.run()
+    """
+    handlers = {'inbound'  : Inbound,
+                'outbound' : Outbound}
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+
+        # Validate every group (and warm up the config cache) once at startup
+        config = _Config(self.config_file, None)
+        (status, confs) = config.parseAll()
+
+        if not status:
+            print "[ConfigError] %s" % confs
+            sys.exit(1)
+
+        self.conf = confs.values()[0]
+        self.stopping = threading.Event()
+
+        # Pin indexes are kept up to date here, so forked sessions start
+        # out with a loaded one
+        self.sqls = {}
+        for conf in confs.values():
+            db_file = conf['sqlite_database']
+            if db_file not in self.sqls:
+                self.sqls[db_file] = _SQL(db_file)
+                _client_indexes[db_file] = _ClientIndex()
+
+        self.server = _FastAGITCPServer((self.conf['fastagi_host'], self.conf['fastagi_port']), _FastAGIHandler)
+        self.server.hotline = self
+        self.server.max_children = self.conf['fastagi_max_children']
+        self.server.timeout = 0.5
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._stopHandler)
+
+        while not self.stopping.isSet():
+            self._refreshClients()
+
+            try:
+                self.server.handle_request()
+            except select.error, e:
+                # Interrupted by a signal
+                continue
+
+        self.server.server_close()
+
+    def _stopHandler(self, signum, frame):
+        self.stopping.set()
+
+    def _refreshClients(self):
+        for (db_file, sql) in self.sqls.iteritems():
+            try:
+                _client_indexes[db_file].refresh(sql)
+            except sqlite3.Error, e:
+                sys.stderr.write("[FastAGI] Unable to load clients of '%s'; Exception: %s\n" % (db_file, e))
+
+    @classmethod
+    def route(cls, env):
+        """
+        Returns tuple (group, handler name) for an AGI environment, or
+        (None, None) if the request path does not name both.
+        """
+        script = env.get('agi_network_script')
+        if not script:
+            request = env.get('agi_request', '')
+            if '://' not in request:
+                return (None, None)
+
+            request = request.split('://', 1)[1]
+            if '/' not in request:
+                return (None, None)
+            script = request.split('/', 1)[1]
+
+        parts = [part for part in script.split('?', 1)[0].split('/') if part]
+        if len(parts) != 2:
+            return (None, None)
+        return (parts[0], parts[1])
+
+    def handle(self, rfile, wfile):
+        """ Runs a single AGI session (in the forked child) """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        try:
+            agi_obj = agi.AGI(stdin=rfile, stdout=wfile)
+        except TypeError:
+            # Older pyst versions always talk to sys.stdin/sys.stdout
+            (sys.stdin, sys.stdout) = (rfile, wfile)
+            agi_obj = agi.AGI()
+
+        (group, name) = self.route(agi_obj.env)
+        if name not in self.handlers:
+            sys.stderr.write("[FastAGI] No handler for request '%s'\n" % agi_obj.env.get('agi_request'))
+            agi_obj.hangup()
+            return
+
+        config = _Config(self.config_file, group)
+        (status, conf) = config.parse()
+        if not status:
+            sys.stderr.write("[ConfigError] %s\n" % conf)
+            agi_obj.hangup()
+            return
+
+        session = self.handlers[name](self.config_file, group, conf=conf, agi_obj=agi_obj)
+        try:
+            session.run()
+        finally:
+            # The child leaves through os._exit(), skipping logging's own flush
+            _flushLogs()
+
+class _FastAGITCPServer(SocketServer.ForkingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+class _FastAGIHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.server.hotline.handle(self.rfile, self.wfile)
+
+class _ManagerSession:
+    """
+    A manager (AMI) connection that can be shared by several queues. Event
+    handlers registered through register() are (re)attached on every login.
+    A failed login is retried no sooner than after an exponential backoff
+    (1..60 seconds).
+
+    pyst pairs responses with actions in the order they arrive and does not
+    lock send_action(); every action goes through originate()/hangup()
+    (or holds 'send_lock'), so queues sharing the session never receive
+    each other's responses.
+    """
+    def __init__(self, conf, log):
+        self.conf = conf
+        self.log = log
+        self.mgr = manager.Manager()
+        self.ready = False
+        self.handlers = []
+        self.lock = threading.RLock()
+        self.send_lock = threading.Lock()
+        self.backoff = 0
+        self.next_login = 0
+
+    def register(self, event, func):
+        self.lock.acquire()
+        try:
+            self.handlers.append((event, func))
+            if self.ready:
+                self.mgr.register_event(event, func)
+        finally:
+            self.lock.release()
+
+    def ensure(self):
+        """
+        Logs in, unless an existing session is still connected.
+        Returns True/False.
+        """
+        self.lock.acquire()
+        try:
+            if self.ready:
+                if self.mgr.connected():
+                    return True
+
+                self.log.warning("Manager connection lost. Reconnecting...")
+                self.close()
+                self.mgr = manager.Manager()
+
+            if _monotonic() < self.next_login:
+                return False
+
+            try:
+                self.mgr.connect(str(self.conf['manager_host']), self.conf['manager_port'])
+                self.send_lock.acquire()
+                try:
+                    self.mgr.login(self.conf['manager_username'], self.conf['manager_password'])
+                finally:
+                    self.send_lock.release()
+            except Exception, e:
+                self.backoff = min(max(self.backoff * 2, 1), 60)
+                self.next_login = _monotonic() + self.backoff
+                self.log.critical("ERROR: Unable to start manager connection; retrying in %s seconds. Exception: %s", self.backoff, e)
+                return False
+
+            for (event, func) in self.handlers:
+                self.mgr.register_event(event, func)
+
+            self.ready = True
+            self.backoff = 0
+            return True
+        finally:
+            self.lock.release()
+
+    def originate(self, **kwargs):
+        self.send_lock.acquire()
+        try:
+            return self.mgr.originate(**kwargs)
+        finally:
+            self.send_lock.release()
+
+    def hangup(self, channel):
+        self.send_lock.acquire()
+        try:
+            return self.mgr.hangup(channel)
+        finally:
+            self.send_lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.ready = False
+            try:
+                self.send_lock.acquire()
+                try:
+                    self.mgr.logoff()
+                finally:
+                    self.send_lock.release()
+                self.mgr.close()
+            except Exception, e:
+                self.log.debug("Unable to close manager connection cleanly; Exception: %s", e)
+        finally:
+            self.lock.release()
+
+class _AGISession:
+    """
+    Wraps an agi.AGI object for the duration of a call. Channel variables
+    set by the queue runner (id, msg_id, ...) are fetched once through
+    variable() and cached, and every AGI command is timed; logStats() logs
+    the number of round trips and the time spent per command.
+    """
+    def __init__(self, agi_obj, log):
+        self.agi = agi_obj
+        self.log = log
+        self.variables = {}
+        self.stats = {}
+        self.started = _monotonic()
+
+    def __getattr__(self, name):
+        attr = getattr(self.agi, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = _monotonic()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._record(name, _monotonic() - start)
+        return timed
+
+    def variable(self, name):
+        """ Returns a channel variable that does not change during the call """
+        if name not in self.variables:
+            self.variables[name] = self.get_variable(name)
+        return self.variables[name]
+
+    def logStats(self):
+        commands = sum([count for (count, elapsed) in self.stats.values()])
+        elapsed = sum([elapsed for (count, elapsed) in self.stats.values()])
+        details = ', '.join(['%s: %s/%.3fs' % (name, self.stats[name][0], self.stats[name][1]) for name in sorted(self.stats.keys())])
+
+        self.log.info("AGI session: %s commands, %.3fs in AGI, %.3fs in total (%s)",
+                      commands, elapsed, _monotonic() - self.started, details)
+
+    def _record(self, name, elapsed):
+        stats = self.stats.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+
+class _ClientIndex:
+    """
+    In-memory pin -> client map of a db, kept by long-lived processes (ie.
+    FastAGIServer) so caller authentication is a dict lookup. Every lookup
+    compares the db's 'clients_version' (bumped by triggers on any change to
+    'clients') with the loaded version and reloads the map when it differs.
+    """
+    def __init__(self):
+        self.version = None
+        self.clients = {}
+
+    def refresh(self, sql):
+        version = sql.fetchClientsVersion()
+        if version != self.version:
+            self.clients = dict([(client.pin, client) for client in sql.fetchClients()])
+            self.version = version
+
+    def lookup(self, sql, pin):
+        self.refresh(sql)
+        return self.clients.get(_Misc.normalizePin(pin))
+
+    def count(self, sql):
+        self.refresh(sql)
+        return len(self.clients)
+
+class _Record(object):
+    """
+    Base class for the compact, slot based records passed around instead of
+    per-row dicts. Item access (record['id']) is kept for compatibility.
+    Records are built from plain row tuples holding their columns in
+    __slots__ order (see _SQL.tuples); trailing slots default to None.
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for (name, value) in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.get(name))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % (name, getattr(self, name)) for name in self.__slots__]))
+
+    @classmethod
+    def fromRow(cls, row):
+        return cls(*row)
+
+class _Issue(_Record):
+    """
+    An issue (messages row joined with its client's name), plus the state of
+    its current dispatch round: 'calls' placed and the 'error' that ended it
+    """
+    __slots__ = ('id', 'client_id', 'msg_id', 'caller_id', 'date', 'status', 'employee', 'name', 'attempts', 'handled_type', 'calls', 'error')
+
+    def channelVars(self):
+        """ The channel variables Outbound needs for this issue """
+        return {'id' : self.id, 'msg_id' : self.msg_id, 'name' : self.name}
+
+class _Client(_Record):
+    __slots__ = ('client_id', 'name', 'pin')
+
+class _Contact(_Record):
+    __slots__ = ('name', 'number', 'schedule', 'emergency', 'priority')
+
+    @classmethod
+    def fromDict(cls, contact):
+        return cls(**dict([(name, contact[name]) for name in cls.__slots__]))
+
+def _waitCondition(cond, predicate, timeout):
+    """
+    Waits on 'cond' (held by the caller) until predicate() is true or
+    'timeout' seconds have passed; returns predicate(). The condition is
+    waited on without a timeout, so a notify() wakes the caller right away;
+    a timed wait would poll in python 2. The deadline is kept by a
+    threading.Timer, which itself waits (and polls) on the wall clock, so it
+    fires within a few dozen milliseconds of 'timeout' and a clock jump
+    moves it.
+    """
+    expired = []
+
+    def expire():
+        cond.acquire()
+        try:
+            expired.append(True)
+            cond.notifyAll()
+        finally:
+            cond.release()
+
+    if timeout <= 0:
+        return predicate()
+
+    timer = threading.Timer(timeout, expire)
+    timer.setDaemon(True)
+    timer.start()
+
+    try:
+        while not predicate() and not expired:
+            cond.wait()
+        return predicate()
+    finally:
+        timer.cancel()
+
+class _Call:
+    """
+    State of a single originated call. A call is matched to its
+    OriginateResponse event by ActionID, to its Hangup event by the
+    Uniqueid carried in the OriginateResponse and to Outbound's accept
+    event by 'token' (passed along as the 'call_id' channel variable).
+
+    The manager event thread flips 'orig_event'/'hangup_event'/'accepted'
+    through signal(), which wakes the dispatcher thread blocked in wait()
+    right away. Calls rung together share one condition.
+    """
+    def __init__(self, number, msg, contact=None, cond=None):
+        self.number = number
+        self.msg = msg
+        self.contact = contact
+        self.token = _Misc.genRandom(16)
+        self.action_id = None
+        self.unique_id = None
+        self.channel = None
+        self.started = None
+        self.answered_at = None
+        self.orig_event = False
+        self.hangup_event = False
+        self.accepted = False
+        self.cancelled = False
+        self.signalled = {}
+
+        if cond is None:
+            cond = threading.Condition()
+        self.cond = cond
+
+    def signal(self, attr):
+        self.cond.acquire()
+        try:
+            setattr(self, attr, True)
+            self.signalled[attr] = _monotonic()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait(self, attr, timeout):
+        """
+        Blocks until 'attr' is set or 'timeout' seconds have passed; returns
+        the value of 'attr'.
+        """
+        self.cond.acquire()
+        try:
+            return _waitCondition(self.cond, lambda: getattr(self, attr), timeout)
+        finally:
+            self.cond.release()
+
+    def state(self):
+        return (self.orig_event, self.hangup_event, self.accepted)
+
+    def deadline(self, origin_timeout, hangup_timeout):
+        """ When to give up waiting on the call; None once its originate has failed """
+        if not self.orig_event:
+            return self.started + origin_timeout
+        if self.answered_at is None:
+            return None
+        return self.answered_at + hangup_timeout
+
+    def done(self):
+        """ Failed, hung up or past its deadline """
+        if self.orig_event and not self.unique_id:
+            return True
+        if self.hangup_event:
+            return True
+        return False
+
+def checkConfig(config_file, groups=None):
+    """
+    Fully validates the config for every hotline group (or only 'groups')
+    and refreshes the config cache used by Inbound/Outbound.
+    Returns tuple (bool status, string message).
+    """
+    config = _Config(config_file, None)
+    (status, result) = config.parseAll(groups)
+    if not status:
+        return (False, "[ConfigError] %s" % result)
+    return (True, "Config OK (%s)" % ', '.join(sorted(result.keys())))
+
+class _Misc:
+    """
+    Miscelaneous class functions used by other classes in the module.
+    """
+    @classmethod
+    def getTime(cls):
+        return (datetime.datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+
+    @classmethod
+    def logFields(cls, msg=None, contact=None, call=None):
+        """
+        Returns the fields ('extra') of log records about an issue/call,
+        written out by the JSON log format.
+        """
+        if call is not None:
+            msg = msg or call.msg
+            contact = contact or call.contact
+
+        fields = {}
+        if msg is not None:
+            fields['issue'] = msg.id
+        if contact is not None:
+            fields['contact'] = contact.name
+        if call is not None:
+            fields['call_id'] = call.token
+        return fields
+
+    @classmethod
+    def timestamp(cls, date):
+        """
+        Returns the unix time of a date as written by getTime(), or None.
+        (time.strptime() is not safe to call from several threads at once.)
+        """
+        try:
+            (day, clock) = date.split(' ')
+            fields = [int(x) for x in day.split('-') + clock.split(':')]
+            return time.mktime(tuple(fields) + (0, 0, -1))
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            return None
+
+    @classmethod
+    def genRandom(cls, length=8):
+        return ''.join([random.choice(string.hexdigits) for n in xrange(length)])
+
+    @classmethod
+    def normalizePin(cls, pin):
+        """ Returns a pin (as entered or stored) as integer; None if invalid """
+        pin = str(pin).strip()
+        if not pin.isdigit():
+            return None
+        return int(pin)
+
+    @classmethod
+    def buildEmail(cls, email, files=[], budget=None):
+        """
+        Expects an email dictionary; returns an iterator over the message
+        (in chunks of whole lines) or None if the dictionary is incomplete.
+        Attachments are read and base64 encoded block by block while the
+        message is being sent, so memory use does not grow with their size.
+        Attachments that do not exist, or that do not fit into 'budget'
+        bytes (None: no limit), are left out and listed (by msg_id) in the
+        message body instead.
+        """
+        req_params = ['to', 'from', 'subject', 'message']
+        if type(email) is not dict:
+            return None
+
+        for req in req_params:
+            if req not in email:
+                return None
+
+        if type(files) is not list:
+            return None
+
+        attached = []
+        missing = []
+        omitted = []
+        used = 0
+
+        for f in files:
+            if not os.path.exists(f):
+                missing.append(f)
+                continue
+
+            size = os.path.getsize(f)
+            if budget is not None and used + size > budget:
+                omitted.append(f)
+                continue
+
+            used += size
+            attached.append(f)
+
+        body = email['message']
+        if missing:
+            body += "\nMissing attachments: %s\n" % ', '.join([os.path.basename(f) for f in missing])
+        if omitted:
+            body += "\nRecordings not attached (over the %s byte attachment budget), msg_id: %s\n" % \
+                    (budget, ', '.join([os.path.splitext(os.path.basename(f))[0] for f in omitted]))
+
+        return cls._emailChunks(email, body, attached)
+
+    @classmethod
+    def _emailChunks(cls, email, body, files):
+        boundary = '===============%s==' % cls.genRandom(16)
+
+        # Only the headers of each part come from the email package; the
+        # parts themselves are written out here
+        msg = MIMEBase('multipart', 'mixed', boundary=boundary)
+        msg['From'] = email['from']
+        msg['To'] = email['to']
+        msg['Date'] = formatdate(localtime=True)
+        msg['Subject'] = email['subject']
+        yield ''.join(['%s: %s\n' % header for header in msg.items()]) + '\n'
+
+        yield '--%s\n' % boundary
+        yield MIMEText(body).as_string() + '\n'
+
+        for f in files:
+            part = MIMEBase('application', "octet-stream")
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(f))
+            yield '\n--%s\n' % boundary
+            yield part.as_string()
+
+            attachment_fh = open(f, 'rb')
+            try:
+                while True:
+                    # 57 bytes make up one 76 character line of base64
+                    block = attachment_fh.read(57 * 1024)
+                    if not block:
+                        break
+                    yield base64.encodestring(block)
+            finally:
+                attachment_fh.close()
+
+        yield '\n--%s--\n' % boundary
+
+    @classmethod
+    def writeEmail(cls, smtp, email, chunks):
+        """
+        Sends a message built by buildEmail() over a connected smtplib.SMTP
+        object, streaming it chunk by chunk. Raises smtplib exceptions.
+        """
+        smtp.ehlo_or_helo_if_needed()
+
+        (code, resp) = smtp.mail(email['from'])
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, email['from'])
+
+        (code, resp) = smtp.rcpt(email['to'])
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({email['to'] : (code, resp)})
+
+        (code, resp) = smtp.docmd('data')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+
+        for chunk in chunks:
+            smtp.send(smtplib.quotedata(chunk))
+        smtp.send('.\r\n')
+
+        (code, resp) = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+class _PromptCache:
+    """
+    Keeps prompts rendered by the Swift TTS engine as audio files in
+    'cache_dir', keyed by a hash of the prompt text and voice, so static
+    prompts are rendered once instead of on every call. The cache is
+    shared by all processes of a group and bounded to 'size' bytes; hits
+    refresh a file's mtime and the least recently used files are evicted
+    after each render. Once the Swift binary turns out to be missing (or
+    failing), prompts are no longer rendered for the rest of the process
+    and lookup() goes straight to the live fallback.
+    """
+    extension = '.wav'
+
+    # Swift binaries that could not render a prompt in this process
+    broken = set()
+
+    def __init__(self, cache_dir, size, voice, swift, log):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.voice = voice
+        self.swift = swift
+        self.log = log
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def lookup(self, text):
+        """
+        Returns the path (without extension) of the rendered prompt,
+        rendering it first if needed; None if it could not be rendered.
+        """
+        path = os.path.join(self.cache_dir, md5('%s\0%s' % (self.voice or '', text)).hexdigest())
+
+        try:
+            os.utime(path + self.extension, None)
+            return path
+        except OSError:
+            pass
+
+        if self.swift in self.broken or not self._render(text, path + self.extension):
+            return None
+
+        self._evict()
+        return path
+
+    def _render(self, text, file):
+        tmp_file = '%s.%s%s' % (file, _Misc.genRandom(), self.extension)
+        args = [self.swift, '-o', tmp_file, '-p', 'audio/channels=1,audio/sampling-rate=8000']
+        if self.voice:
+            args += ['-n', self.voice]
+
+        try:
+            null_fh = open(os.devnull, 'w')
+            try:
+                status = subprocess.call(args + [text], stdout=null_fh, stderr=null_fh)
+            finally:
+                null_fh.close()
+
+            if status != 0 or not os.path.getsize(tmp_file):
+                raise OSError("'%s' exited with status %s" % (self.swift, status))
+
+            # Another process may render the same prompt; rename is atomic
+            os.rename(tmp_file, file)
+        except (OSError, IOError), e:
+            self.log.warning("Unable to render prompt '%s'; not rendering prompts with '%s' any more. Exception: %s", text, self.swift, e)
+            self.broken.add(self.swift)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+
+        return True
+
+    def _evict(self):
+        files = []
+        total = 0
+
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.extension):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        files.sort()
+
+        # Always keeps the most recently used prompt, even if it is too big
+        for (mtime, size, name) in files[:-1]:
+            if total <= self.size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+class _MessageStore:
+    """
+    Stores recordings below 'message_dir' in two levels of hashed
+    subdirectories (message_dir/ab/cd/<msg_id>.gsm), so no directory grows
+    past a few hundred entries. Message ids are time ordered (milliseconds
+    since the epoch + random bits, in hex) and reserved by creating their
+    file exclusively, so two recordings can never share an id. Recordings
+    made before the store existed (8 character ids) stay in 'message_dir'.
+    """
+    extension = '.gsm'
+    id_length = 20
+
+    def __init__(self, message_dir):
+        self.message_dir = message_dir
+
+    def newId(self):
+        """ Returns a new message id; its (empty) recording file exists """
+        while True:
+            msg_id = '%012x%s' % (int(time.time() * 1000), os.urandom(4).encode('hex'))
+            path = self.recording(msg_id)
+
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644))
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+
+            return msg_id
+
+    def path(self, msg_id):
+        """ Path of a recording without extension (as Asterisk expects it) """
+        if len(msg_id) != self.id_length:
+            return os.path.join(self.message_dir, msg_id)
+
+        shard = md5(msg_id).hexdigest()
+        return os.path.join(self.message_dir, shard[:2], shard[2:4], msg_id)
+
+    def recording(self, msg_id):
+        return self.path(msg_id) + self.extension
+
+    def sweep(self, before, keep=()):
+        """
+        Removes recordings created before 'before' (unix time), except the
+        ones in 'keep' (ie. recordings of open issues). Recordings that never
+        made it into the db (ie. the caller hung up) are removed as well.
+        Returns the number of removed recordings.
+        """
+        keep = set(keep)
+        removed = 0
+
+        for (dir, name) in self._walk():
+            msg_id = name[:-len(self.extension)]
+            if msg_id in keep:
+                continue
+
+            path = os.path.join(dir, name)
+            try:
+                if len(msg_id) == self.id_length:
+                    created = int(msg_id[:12], 16) / 1000.0
+                else:
+                    created = os.path.getmtime(path)
+
+                if created < before:
+                    os.remove(path)
+                    removed += 1
+            except (OSError, ValueError), e:
+                continue
+
+        return removed
+
+    def _walk(self):
+        """ Yields (directory, file name) for every stored recording """
+        shard_chars = set('0123456789abcdef')
+
+        def shards(dir):
+            try:
+                names = os.listdir(dir)
+            except OSError:
+                return []
+            return [os.path.join(dir, name) for name in sorted(names)
+                    if len(name) == 2 and set(name) <= shard_chars and os.path.isdir(os.path.join(dir, name))]
+
+        for name in os.listdir(self.message_dir):
+            if name.endswith(self.extension):
+                yield (self.message_dir, name)
+
+        for top in shards(self.message_dir):
+            for dir in shards(top):
+                for name in os.listdir(dir):
+                    if name.endswith(self.extension):
+                        yield (dir, name)
+
+class _Metrics:
+    """
+    Process wide registry of the dispatch metrics (see 'definitions'),
+    rendered in the Prometheus text format - served over HTTP by serve()
+    ('metrics_port') and/or written to a textfile collector file by
+    writeTextfile() ('metrics_textfile'). Values are keyed by their label
+    values, in the order of the metric's label names. A textfile's earlier
+    values are loaded back before it is first written (see loadTextfile), so
+    counters and histograms stay cumulative across cron runs.
+    """
+    # name -> (type, help, label names, histogram buckets)
+    definitions = {
+        'hotline_originate_seconds' : ('histogram', "Time from originating a call until Asterisk reports it answered or failed",
+                                       ('group', 'contact', 'result'), (1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120)),
+        'hotline_call_seconds'      : ('histogram', "Time from answering a call until its hangup",
+                                       ('group', 'contact'), (5, 10, 20, 30, 60, 120, 180, 300, 600)),
+        'hotline_accept_seconds'    : ('histogram', "Time from answering a call until the contact accepted the issue",
+                                       ('group', 'contact'), (2.5, 5, 10, 20, 30, 60, 120)),
+        'hotline_issue_ack_seconds' : ('histogram', "Time from the creation of an issue until it was accepted",
+                                       ('group',), (10, 30, 60, 120, 300, 600, 1800, 3600, 7200)),
+        'hotline_issue_attempts'    : ('histogram', "Queue run attempts an issue needed until it was accepted or given up on",
+                                       ('group',), (1, 2, 3, 5, 10)),
+        'hotline_calls_total'       : ('counter', "Calls made to contacts, by result",
+                                       ('group', 'contact', 'result'), None),
+        'hotline_issues_total'      : ('counter', "Dispatched issues, by result",
+                                       ('group', 'result'), None),
+    }
+
+    sample_re = re.compile(r'^([a-z_]+?)(_bucket|_sum|_count)?\{(.*)\} (\S+)$')
+    label_re = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.server = None
+        self.loaded = set()
+
+    def inc(self, name, labels, value=1):
+        self.lock.acquire()
+        try:
+            series = self.values.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, labels, value):
+        buckets = self.definitions[name][3]
+
+        self.lock.acquire()
+        try:
+            series = self.values.setdefault(name, {})
+            if labels not in series:
+                series[labels] = [[0] * len(buckets), 0.0, 0]
+
+            histogram = series[labels]
+            for (i, bound) in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        finally:
+            self.lock.release()
+
+    def render(self):
+        lines = []
+
+        self.lock.acquire()
+        try:
+            for name in sorted(self.definitions.keys()):
+                (type, help, label_names, buckets) = self.definitions[name]
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+
+                for (labels, value) in sorted(self.values.get(name, {}).items()):
+                    pairs = zip(label_names, labels)
+
+                    if type == 'counter':
+                        lines.append('%s%s %s' % (name, self._labels(pairs), value))
+                        continue
+
+                    (counts, total, count) = value
+                    for (bound, bucket_count) in zip(buckets, counts):
+                        lines.append('%s_bucket%s %s' % (name, self._labels(pairs + [('le', '%g' % bound)]), bucket_count))
+                    lines.append('%s_bucket%s %s' % (name, self._labels(pairs + [('le', '+Inf')]), count))
+                    lines.append('%s_sum%s %r' % (name, self._labels(pairs), total))
+                    lines.append('%s_count%s %s' % (name, self._labels(pairs), count))
+        finally:
+            self.lock.release()
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def loadTextfile(self, path):
+        """
+        Adds the values of a textfile written by an earlier process (once
+        per path). Series whose definition has changed since are dropped.
+        """
+        if path in self.loaded:
+            return
+        self.loaded.add(path)
+
+        try:
+            metrics_fh = open(path)
+        except IOError, e:
+            return
+
+        histograms = {}
+        try:
+            for line in metrics_fh:
+                match = self.sample_re.match(line.strip())
+                if match is None:
+                    continue
+
+                (name, suffix, labels, value) = match.groups()
+                if name not in self.definitions:
+                    continue
+                (type, help, label_names, buckets) = self.definitions[name]
+
+                labels = dict([(label, self._unescape(text)) for (label, text) in self.label_re.findall(labels)])
+                le = labels.pop('le', None)
+                if sorted(labels.keys()) != sorted(label_names):
+                    continue
+                key = tuple([labels[label] for label in label_names])
+
+                if type == 'counter' and suffix is None:
+                    self.inc(name, key, int(float(value)))
+                elif type == 'histogram' and suffix is not None:
+                    histogram = histograms.setdefault((name, key), [[0] * len(buckets), 0.0, 0])
+                    if suffix == '_sum':
+                        histogram[1] = float(value)
+                    elif suffix == '_count':
+                        histogram[2] = int(float(value))
+                    elif le in ['%g' % bound for bound in buckets]:
+                        histogram[0][['%g' % bound for bound in buckets].index(le)] = int(float(value))
+        finally:
+            metrics_fh.close()
+
+        self.lock.acquire()
+        try:
+            for ((name, key), (counts, total, count)) in histograms.items():
+                series = self.values.setdefault(name, {})
+                if key not in series:
+                    series[key] = [[0] * len(counts), 0.0, 0]
+                histogram = series[key]
+                histogram[0] = [x + y for (x, y) in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+        finally:
+            self.lock.release()
+
+    def _unescape(self, value):
+        # Label values are kept as utf-8 byte strings, like contact names
+        return re.sub(r'\\(.)', lambda match: match.group(1) == 'n' and '\n' or match.group(1), value)
+
+    def writeTextfile(self, path):
+        # Written under a temporary name first, so the collector never
+        # reads a partial file
+        tmp_path = '%s.%s.tmp' % (path, _Misc.genRandom())
+        metrics_fh = open(tmp_path, 'w')
+        try:
+            try:
+                metrics_fh.write(self.render())
+            finally:
+                metrics_fh.close()
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError, e:
+                pass
+            raise
+
+    def serve(self, host, port):
+        """ Serves the metrics on http://host:port/metrics (once per process) """
+        if self.server is not None:
+            return
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _labels(self, pairs):
+        escape = lambda value: self._text(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{%s}' % ','.join(['%s="%s"' % (name, escape(value)) for (name, value) in pairs])
+
+    def _text(self, value):
+        # Contact names from the config (and the db) are utf-8 byte strings
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return unicode(value)
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = _metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Dispatch metrics of this process; shared by all groups (see MultiQueue)
+_metrics = _Metrics()
+
+class _AsyncLogHandler(logging.Handler):
+    """
+    Hands log records to a background writer thread, which passes them on
+    to 'target' (ie. a FileHandler), so a slow disk never holds up a call.
+    Up to 'capacity' records are buffered; further records are dropped (and
+    counted in the log) until the writer catches up. flush() waits for the
+    buffered records; logging flushes every handler at exit.
+    """
+    capacity = 10000
+
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self.pid = None
+        self.queue = None
+        self.start_lock = threading.Lock()
+
+    def emit(self, record):
+        self._ensureWriter()
+
+        # Merge the arguments now; they may change once the caller moves on
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except _queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        if self.pid != os.getpid():
+            return
+
+        # Wait (at most 'timeout' seconds) for the writer to reach a marker
+        done = threading.Event()
+        try:
+            self.queue.put(done, True, timeout)
+        except _queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+    def _ensureWriter(self):
+        # Forked children (FastAGIServer) inherit the handler, but not its thread
+        if self.pid == os.getpid():
+            return
+
+        self.start_lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                # The parent's writer may have held the target's lock at fork time
+                if self.pid is not None:
+                    self.target.createLock()
+
+                self.queue = _queue.Queue(self.capacity)
+                writer = threading.Thread(target=self._write, args=(self.queue,))
+                writer.setDaemon(True)
+                writer.start()
+                self.pid = os.getpid()
+        finally:
+            self.start_lock.release()
+
+    def _write(self, queue):
+        while True:
+            record = queue.get()
+            if not isinstance(record, logging.LogRecord):
+                # flush() marker
+                record.set()
+                continue
+
+            if self.dropped:
+                (dropped, self.dropped) = (self.dropped, 0)
+                self.target.handle(logging.makeLogRecord({'name'      : record.name,
+                                                          'levelno'   : logging.WARNING,
+                                                          'levelname' : 'WARNING',
+                                                          'msg'       : "Log buffer full; dropped %s records" % dropped}))
+            self.target.handle(record)
+
+class _JSONFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines: time, level, group and message, plus the
+    'issue', 'contact' and 'call_id' fields of records that carry them
+    (passed along through the 'extra' argument; see _Misc.logFields).
+    """
+    fields = ('issue', 'contact', 'call_id')
+
+    def format(self, record):
+        entry = {'time'    : '%s.%03d' % (self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), record.msecs),
+                 'level'   : record.levelname.lower(),
+                 'group'   : record.name.split('.', 1)[-1],
+                 'message' : record.getMessage()}
+
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, sort_keys=True)
+
+def _flushLogs():
+    """
+    Waits for the buffered records of every async log handler; called by
+    processes that leave through os._exit (forked FastAGI children).
+    """
+    for handler in _log_handlers.values():
+        handler.flush()
+
+class _Mailer:
+    """
+    Delivers notification emails through an on-disk spool, so neither a slow
+    nor a down mail relay holds up (or loses) a notification. enqueue()
+    only writes the email to 'spool_dir'; a background thread (or an
+    explicit deliver() pass) sends spooled emails over a reused SMTP
+    connection. Failed deliveries are retried with exponential backoff
+    (1 minute .. 1 hour); emails that could not be delivered within a day,
+    or that cannot be built at all, are moved to 'spool_dir/failed'.
+    Delivery counters are kept in 'stats'.
+
+    Several processes may share a spool (cron runners, groups with the same
+    'spool_dir'): an email is claimed by renaming it to a name of this
+    mailer's own before it is sent. Claims older than 'claim_timeout'
+    (a sender that died halfway) are put back into the spool.
+    """
+    min_backoff = 60
+    max_backoff = 3600
+    max_age = 86400
+    claim_timeout = 3600
+    idle_timeout = 60
+    smtp_timeout = 30
+
+    def __init__(self, spool_dir, host, port, log, attachment_budget=None):
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        self.host = host
+        self.port = port
+        self.attachment_budget = attachment_budget
+        self.log = log
+        self.owner = '%s-%s-%s' % (socket.gethostname(), os.getpid(), _Misc.genRandom())
+
+        self.smtp = None
+        self.smtp_used = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stats = {'queued' : 0, 'sent' : 0, 'retried' : 0, 'failed' : 0, 'connections' : 0}
+
+        for path in (self.spool_dir, self.failed_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def enqueue(self, email, files=[]):
+        """ Spools an email (see _Misc.buildEmail); returns True/False """
+        now = time.time()
+        entry = {'email'        : email,
+                 'files'        : files,
+                 'created'      : now,
+                 'attempts'     : 0,
+                 'next_attempt' : now}
+
+        name = '%d-%s.json' % (now * 1000, _Misc.genRandom())
+        try:
+            self._write(os.path.join(self.spool_dir, name), entry)
+        except (IOError, OSError), e:
+            self.log.critical("Unable to spool notification email; Exception: %s", e)
+            return False
+
+        self.stats['queued'] += 1
+        self.wakeup.set()
+        return True
+
+    def start(self):
+        """ Starts the background sender thread (if not running yet) """
+        if self.thread is not None and self.thread.isAlive():
+            return
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                delay = self.deliver()
+            except Exception, e:
+                self.log.critical("Notification sender failed; Exception: %s", e)
+                delay = self.min_backoff
+
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+    def deliver(self):
+        """
+        Sends every due email in the spool. Returns the number of seconds
+        until the next spooled email is due (at most 'idle_timeout').
+        """
+        self.lock.acquire()
+        try:
+            return self._deliver()
+        finally:
+            self.lock.release()
+
+    def _deliver(self):
+        delay = self.idle_timeout
+        worked = False
+
+        for name in sorted(os.listdir(self.spool_dir)):
+            if name.endswith('.tmp'):
+                continue
+            if '.json.' in name:
+                self._reclaim(name)
+                continue
+            if not name.endswith('.json'):
+                continue
+
+            path = os.path.join(self.spool_dir, name)
+            try:
+                entry = json.load(open(path))
+            except (IOError, OSError), e:
+                # Claimed (or sent) by another process meanwhile
+                continue
+            except ValueError, e:
+                self.log.critical("Unreadable spooled email '%s'; moving it to '%s'", name, self.failed_dir)
+                self._moveFailed(path, name)
+                continue
+
+            now = time.time()
+            if entry['next_attempt'] > now:
+                delay = min(delay, entry['next_attempt'] - now)
+                continue
+
+            claimed = self._claim(path)
+            if claimed is None:
+                continue
+
+            worked = True
+            try:
+                error = self._send(entry)
+            except Exception, e:
+                # Retrying won't help (eg. an unencodable header); don't
+                # let the email hold up the rest of the spool
+                self.log.critical("Unable to build notification email '%s'; moved to '%s'. Exception: %s", name, self.failed_dir, e)
+                self._moveFailed(claimed, name)
+                self.stats['failed'] += 1
+                continue
+
+            if error is None:
+                os.remove(claimed)
+                self.stats['sent'] += 1
+                continue
+
+            entry['attempts'] += 1
+
+            if now - entry['created'] > self.max_age:
+                self.log.critical("Giving up on notification email '%s' after %s attempts; moved to '%s'. Last error: %s", name, entry['attempts'], self.failed_dir, error)
+                self._moveFailed(claimed, name)
+                self.stats['failed'] += 1
+                continue
+
+            backoff = min(self.min_backoff * 2 ** (entry['attempts'] - 1), self.max_backoff)
+            entry['next_attempt'] = now + backoff
+            self._write(path, entry)
+            os.remove(claimed)
+            self.stats['retried'] += 1
+            delay = min(delay, backoff)
+            self.log.warning("Unable to send notification email through '%s:%s' (attempt %s); retrying in %s seconds. Error: %s", self.host, self.port, entry['attempts'], backoff, error)
+
+            # The relay is unreachable; don't wait for it once per spooled email
+            if isinstance(error, (socket.error, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected)):
+                break
+
+        if self.smtp is not None and _monotonic() - self.smtp_used > self.idle_timeout:
+            self._disconnect()
+
+        if worked:
+            self.log.info("Notification stats: %s", ', '.join(['%s=%s' % (key, self.stats[key]) for key in sorted(self.stats.keys())]))
+
+        return max(delay, 0)
+
+    def _claim(self, path):
+        # Atomic; exactly one of several processes renaming an entry wins.
+        # The claim's mtime tells when it was made (see _reclaim)
+        claimed = '%s.%s' % (path, self.owner)
+        try:
+            os.rename(path, claimed)
+            os.utime(claimed, None)
+        except OSError, e:
+            return None
+        return claimed
+
+    def _reclaim(self, name):
+        # Puts back entries claimed by a sender that did not finish them
+        path = os.path.join(self.spool_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) < self.claim_timeout:
+                return
+            os.rename(path, os.path.join(self.spool_dir, name[:name.index('.json.') + 5]))
+        except OSError, e:
+            return
+        self.log.warning("Returned stale claim '%s' to the spool", name)
+
+    def _moveFailed(self, path, name):
+        try:
+            os.rename(path, os.path.join(self.failed_dir, name))
+        except OSError, e:
+            self.log.critical("Unable to move spooled email '%s' to '%s'; Exception: %s", name, self.failed_dir, e)
+
+    def _send(self, entry):
+        """
+        Returns None on success, the (transient) error otherwise. Raises if
+        the email cannot be built.
+        """
+        email = entry['email']
+        chunks = _Misc.buildEmail(email, entry['files'], self.attachment_budget)
+        if chunks is None:
+            raise ValueError("Incomplete email")
+
+        try:
+            smtp = self._connection()
+            _Misc.writeEmail(smtp, email, chunks)
+        except UnicodeError, e:
+            self._disconnect(graceful=False)
+            raise
+        except Exception, e:
+            # The session may be stuck halfway through DATA; don't QUIT
+            self._disconnect(graceful=False)
+            return e
+
+        self.smtp_used = _monotonic()
+        return None
+
+    def _connection(self):
+        # Reuse the previous connection if the relay still answers
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except Exception, e:
+                pass
+            self._disconnect()
+
+        self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.smtp_timeout)
+        self.stats['connections'] += 1
+        return self.smtp
+
+    def _disconnect(self, graceful=True):
+        if self.smtp is None:
+            return
+
+        try:
+            if graceful:
+                self.smtp.quit()
+            else:
+                self.smtp.close()
+        except Exception, e:
+            pass
+        self.smtp = None
+
+    def _write(self, path, entry):
+        tmp_path = path + '.tmp'
+        spool_fh = open(tmp_path, 'w')
+        json.dump(entry, spool_fh)
+        spool_fh.close()
+        os.rename(tmp_path, path)
+
+def _synchronized(func):
+    """ Serializes calls to 'func' on the instance's 'lock' """
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.lock.release()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def _clearDuplicatePins(cur):
+    """
+    Schema 5 migration step: clears the pin of every client that shares it
+    with an older client. The cleared pins are kept in
+    'clients_cleared_pins' and the affected clients are reported on stderr,
+    so they can be given a pin of their own.
+    """
+    cur.execute("CREATE TABLE clients_cleared_pins (client_id INT, pin, cleared_at TEXT)")
+    cur.execute("INSERT INTO clients_cleared_pins (client_id, pin, cleared_at) SELECT client_id, pin, ? FROM clients " +
+                "WHERE pin IS NOT NULL AND client_id NOT IN (SELECT MIN(client_id) FROM clients GROUP BY pin)", (_Misc.getTime(),))
+
+    cur.execute("SELECT client_id, pin FROM clients_cleared_pins ORDER BY client_id")
+    for row in cur.fetchall():
+        sys.stderr.write("[Migration] Client #%s shares PIN %s with an older client; its PIN has been cleared\n" % (row[0], row[1]))
+
+    cur.execute("UPDATE clients SET pin = NULL WHERE client_id IN (SELECT client_id FROM clients_cleared_pins)")
+
 class _SQL:
     """
     sqlite messages.status:
         0 - new/unhandled issue
         1 - success 
         2 - failure
+        3 - dispatching (claimed by the queue runner in 'owner' until
+            'lease_expires')
+
+    New issues that were not accepted in a dispatch round go back to
+    status 0 until their 'next_attempt' is due; 'attempts' counts the rounds.
+
+    The connection is shared by the queue dispatcher threads; every query
+    method holds 'lock' for the duration of its execute/fetch.
+
+    The db runs in WAL mode (set by upgradeSchema()), so the queue runner's
+    updates no longer block inbound inserts; writers wait up to
+    'busy_timeout' seconds for each other instead of failing with
+    "database is locked".
     """
+    busy_timeout = 10.0
+
+    # Schema migrations - (version, statements); statements are SQL strings
+    # or callables taking the cursor. Version 1 is the schema created by
+    # setupDatabase() before the db was versioned.
+    migrations = [
+        (2, ["CREATE INDEX IF NOT EXISTS messages_status ON messages(status)",
+             "CREATE INDEX IF NOT EXISTS messages_client_id ON messages(client_id)",
+             "CREATE INDEX IF NOT EXISTS clients_pin ON clients(pin)"]),
+        (3, ["ALTER TABLE messages ADD COLUMN owner TEXT",
+             "ALTER TABLE messages ADD COLUMN lease_expires INT"]),
+        # Colliding msg_ids used to overwrite the older recording; the rows
+        # that lost their recording get a distinct msg_id first
+        (4, ["UPDATE messages SET msg_id = msg_id || '-' || id WHERE id NOT IN (SELECT MAX(id) FROM messages GROUP BY msg_id)",
+             "CREATE UNIQUE INDEX IF NOT EXISTS messages_msg_id ON messages(msg_id)"]),
+        # Pins are stored as integers (the column's affinity takes care of
+        # new rows); a pin shared by several clients only ever matched the
+        # first of them, the others are cleared (see _clearDuplicatePins)
+        (5, ["UPDATE clients SET pin = CAST(trim(pin) AS INTEGER) WHERE typeof(pin) = 'text' AND trim(pin) != '' AND trim(pin) NOT GLOB '*[^0-9]*'",
+             _clearDuplicatePins,
+             "DROP INDEX IF EXISTS clients_pin",
+             "CREATE UNIQUE INDEX clients_pin ON clients(pin)",
+             "CREATE TABLE clients_version (version INT)",
+             "INSERT INTO clients_version (version) VALUES (0)",
+             "CREATE TRIGGER clients_insert AFTER INSERT ON clients BEGIN UPDATE clients_version SET version = version + 1; END",
+             "CREATE TRIGGER clients_update AFTER UPDATE ON clients BEGIN UPDATE clients_version SET version = version + 1; END",
+             "CREATE TRIGGER clients_delete AFTER DELETE ON clients BEGIN UPDATE clients_version SET version = version + 1; END"]),
+        # Escalation state: dispatch rounds so far, when the last one ended
+        # and when the next one is due (unix time; NULL - right away)
+        (6, ["ALTER TABLE messages ADD COLUMN attempts INT NOT NULL DEFAULT 0",
+             "ALTER TABLE messages ADD COLUMN last_attempt INT",
+             "ALTER TABLE messages ADD COLUMN next_attempt INT",
+             "CREATE INDEX IF NOT EXISTS messages_next_attempt ON messages(status, next_attempt)"]),
+        # Recordings of further calls about an issue that was still open
+        # (coalesced into it instead of becoming issues of their own)
+        (7, ["CREATE TABLE message_recordings (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INT NOT NULL, msg_id TEXT NOT NULL, caller_id INT, date TEXT)",
+             "CREATE UNIQUE INDEX message_recordings_msg_id ON message_recordings(msg_id)",
+             "CREATE INDEX message_recordings_message_id ON message_recordings(message_id)"]),
+        # Outcome of every outbound call (see Queue._recordCall); ring_time
+        # in milliseconds, hour - local hour of day in the group's timezone
+        (8, ["CREATE TABLE call_attempts (id INTEGER PRIMARY KEY, contact TEXT NOT NULL, message_id INT, date INT NOT NULL, hour INT, answered INT NOT NULL, ring_time INT, accepted INT NOT NULL)",
+             "CREATE INDEX call_attempts_date ON call_attempts(date)"]),
+    ]
+    schema_version = migrations[-1][0]
+
+    # _Issue's columns, in __slots__ order
+    issue_columns = ', '.join(['messages.id', 'messages.client_id', 'messages.msg_id', 'messages.caller_id', 'messages.date',
+                               'messages.status', 'messages.employee', 'clients.name', 'messages.attempts'])
+
     def __init__(self, db_file):
-        self.con = sqlite3.connect(db_file)
-        self.con.row_factory = self._dictFactory
+        self.con = sqlite3.connect(db_file, timeout=self.busy_timeout, check_same_thread=False)
+        self.con.row_factory = sqlite3.Row
         self.cur = self.con.cursor()
+        self.lock = threading.RLock()
 
-    def updateStatus(self, id, status, name=None):
-        self.cur.execute("UPDATE messages SET status=?, employee=? WHERE id=?", (status, name,id))
-        id = self.cur.lastrowid
+        # Returns plain tuples; records (_Issue, _Client) are built from
+        # those without a sqlite3.Row per row
+        self.tuples = self.con.cursor()
+        self.tuples.row_factory = None
+
+        # Safe in WAL mode and saves an fsync per commit
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+
+    @_synchronized
+    def upgradeSchema(self):
+        """
+        Switches the db to WAL mode and applies all pending migrations in a
+        single transaction. Concurrent upgrades are serialized by
+        BEGIN IMMEDIATE. Returns the number of applied migrations.
+        """
+        applied = 0
+        self.con.isolation_level = None
+
+        try:
+            self.cur.execute("PRAGMA journal_mode=WAL")
+            self.cur.execute("BEGIN IMMEDIATE")
+
+            try:
+                self.cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INT)")
+                self.cur.execute("SELECT version FROM schema_version")
+                row = self.cur.fetchone()
+
+                if row == None:
+                    version = 1
+                    self.cur.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+                else:
+                    version = row['version']
+
+                for (target, statements) in self.migrations:
+                    if target <= version:
+                        continue
+
+                    for statement in statements:
+                        if callable(statement):
+                            statement(self.cur)
+                        else:
+                            self.cur.execute(statement)
+
+                    self.cur.execute("UPDATE schema_version SET version=?", (target,))
+                    applied += 1
+
+                self.cur.execute("COMMIT")
+            except Exception:
+                self.cur.execute("ROLLBACK")
+                raise
+        finally:
+            self.con.isolation_level = ''
+
+        return applied
+
+    @_synchronized
+    def fetchSchemaVersion(self):
+        try:
+            self.cur.execute("SELECT version FROM schema_version")
+        except sqlite3.OperationalError:
+            return 1
+
+        row = self.cur.fetchone()
+        if row != None:
+            return row['version']
+        return 1
+
+    @_synchronized
+    def acceptIssue(self, id, name=None):
+        """
+        Marks an open issue as accepted by 'name'. Returns False if the issue
+        was already accepted (ie. by another contact rung in parallel).
+        """
+        self.cur.execute("UPDATE messages SET status=1, employee=? WHERE id=? AND status IN (0, 3)", (name, id))
+        accepted = self.cur.rowcount == 1
         self.con.commit()
-        return id
+        return accepted
+
+    @_synchronized
+    def fetchEmployee(self, id):
+        self.cur.execute("SELECT employee FROM messages WHERE id=?", (id,))
+        row = self.cur.fetchone()
+        if row != None:
+            return row['employee']
+        return row
 
+    @_synchronized
     def fetchStatus(self, id):
         self.cur.execute("SELECT status FROM messages WHERE id=?", (id,))
         row = self.cur.fetchone()
@@ -624,6 +3428,7 @@ class _SQL:
             return row['status']
         return row
 
+    @_synchronized
     def insertMessage(self, id, msg_id, caller_id):
         cur_date = _Misc.getTime() 
         self.cur.execute("INSERT INTO messages (client_id, msg_id, caller_id, date) VALUES (?, ?, ?, ?)", (id, msg_id, caller_id, cur_date))
@@ -631,30 +3436,310 @@ class _SQL:
         self.con.commit() 
         return id
 
+    @_synchronized
+    def ingestMessage(self, id, msg_id, caller_id, window):
+        """
+        Files a new recording: attaches it to the client's open issue (or
+        the open issue of the same caller id) if that issue had a call in
+        the last 'window' seconds, otherwise inserts a new issue.
+        Returns tuple (issue id, True if the recording was attached).
+        """
+        if not window:
+            return (self.insertMessage(id, msg_id, caller_id), False)
+
+        cur_date = _Misc.getTime()
+        since = (datetime.datetime.now() - datetime.timedelta(seconds=window)).strftime('%Y-%m-%d %H:%M:%S')
+
+        # Only real numbers identify a caller ('unknown', anonymous...)
+        match_caller = str(caller_id).isdigit()
+
+        self.con.isolation_level = None
+        try:
+            self.cur.execute("BEGIN IMMEDIATE")
+            try:
+                self.cur.execute("SELECT id FROM messages WHERE status IN (0, 3) AND (client_id = ? OR (? AND caller_id = ?)) AND " +
+                                 "MAX(date, IFNULL((SELECT MAX(date) FROM message_recordings WHERE message_id = messages.id), date)) >= ? " +
+                                 "ORDER BY id DESC LIMIT 1", (id, match_caller, caller_id, since))
+                row = self.cur.fetchone()
+
+                if row != None:
+                    issue_id = row['id']
+                    self.cur.execute("INSERT INTO message_recordings (message_id, msg_id, caller_id, date) VALUES (?, ?, ?, ?)", (issue_id, msg_id, caller_id, cur_date))
+                    # A new call makes an issue waiting out its retry backoff due right away
+                    self.cur.execute("UPDATE messages SET next_attempt=NULL WHERE id=? AND status=0", (issue_id,))
+                else:
+                    self.cur.execute("INSERT INTO messages (client_id, msg_id, caller_id, date) VALUES (?, ?, ?, ?)", (id, msg_id, caller_id, cur_date))
+                    issue_id = self.cur.lastrowid
+
+                self.cur.execute("COMMIT")
+            except Exception:
+                self.cur.execute("ROLLBACK")
+                raise
+        finally:
+            self.con.isolation_level = ''
+
+        return (issue_id, row != None)
+
+    @_synchronized
+    def fetchRecordings(self, id):
+        """ Returns the msg_ids of the recordings attached to issue 'id' """
+        self.cur.execute("SELECT msg_id FROM message_recordings WHERE message_id=? ORDER BY id", (id,))
+        return [row['msg_id'] for row in self.cur.fetchall()]
+
+    @_synchronized
     def fetchClientByPin(self, pin):
-        self.cur.execute("SELECT * FROM clients WHERE pin=?", (pin,))
-        return self.cur.fetchone()
+        pin = _Misc.normalizePin(pin)
+        if pin is None:
+            return None
 
-    def fetchClientCount(self):
-        self.cur.execute("SELECT COUNT(*) FROM clients")
-        # return first element from values
-        return (self.cur.fetchone()).values()[0]
+        self.tuples.execute("SELECT client_id, name, pin FROM clients WHERE pin=?", (pin,))
+        row = self.tuples.fetchone()
+        if row != None:
+            return _Client.fromRow(row)
+        return row
 
-    def fetchUnhandled(self):
-        self.cur.execute("SELECT messages.*, clients.name FROM messages, clients WHERE messages.status = 0 AND clients.client_id = messages.client_id")
-        return self.cur.fetchall()
+    @_synchronized
+    def fetchClients(self):
+        self.tuples.execute("SELECT client_id, name, pin FROM clients WHERE pin IS NOT NULL")
+        return [_Client.fromRow(row) for row in self.tuples.fetchall()]
+
+    @_synchronized
+    def fetchClientsVersion(self):
+        """ Changes whenever a client is added, changed or removed """
+        self.cur.execute("SELECT version FROM clients_version")
+        return self.cur.fetchone()['version']
+
+    @_synchronized
+    def hasClients(self):
+        self.cur.execute("SELECT 1 FROM clients LIMIT 1")
+        return self.cur.fetchone() is not None
+
+    @_synchronized
+    def claimUnhandled(self, owner, lease, limit):
+        """
+        Atomically claims up to 'limit' new issues whose next attempt is due,
+        or issues whose lease has expired, for 'owner' for 'lease' seconds.
+        Returns the claimed issues (see fetchIssues()).
+        """
+        now = int(time.time())
+
+        self.con.isolation_level = None
+        try:
+            self.cur.execute("BEGIN IMMEDIATE")
+            try:
+                self.cur.execute("SELECT id FROM messages WHERE (status = 0 AND (next_attempt IS NULL OR next_attempt <= ?)) OR (status = 3 AND lease_expires < ?) ORDER BY id LIMIT ?", (now, now, limit))
+                ids = [row['id'] for row in self.cur.fetchall()]
+
+                for id in ids:
+                    self.cur.execute("UPDATE messages SET status=3, owner=?, lease_expires=? WHERE id=?", (owner, now + lease, id))
+
+                self.cur.execute("COMMIT")
+            except Exception:
+                self.cur.execute("ROLLBACK")
+                raise
+        finally:
+            self.con.isolation_level = ''
+
+        if not ids:
+            return []
+        return self.fetchIssues(ids)
+
+    @_synchronized
+    def fetchIssues(self, ids):
+        """ Returns the issues in 'ids' (messages rows joined with the client's name) """
+        self.tuples.execute("SELECT %s FROM messages, clients WHERE messages.id IN (%s) AND clients.client_id = messages.client_id ORDER BY messages.id" %
+                            (self.issue_columns, ', '.join(['?'] * len(ids))), ids)
+        return [_Issue.fromRow(row) for row in self.tuples.fetchall()]
+
+    @_synchronized
+    def fetchAccepted(self, ids, name):
+        """ Returns the ids of the issues in 'ids' accepted by 'name' """
+        self.cur.execute("SELECT id FROM messages WHERE status = 1 AND employee = ? AND id IN (%s)" % ', '.join(['?'] * len(ids)), [name] + list(ids))
+        return [row['id'] for row in self.cur.fetchall()]
+
+    @_synchronized
+    def fetchOpenMsgIds(self):
+        """ Returns the msg_ids of all issues that are not resolved yet (and of their attached recordings) """
+        self.cur.execute("SELECT msg_id FROM messages WHERE status IN (0, 3) UNION ALL " +
+                         "SELECT message_recordings.msg_id FROM message_recordings, messages WHERE messages.id = message_recordings.message_id AND messages.status IN (0, 3)")
+        return [row['msg_id'] for row in self.cur.fetchall()]
+
+    @_synchronized
+    def finishRound(self, owner, id, status, name=None, next_attempt=None):
+        """
+        Ends a dispatch round of an issue claimed by 'owner': counts the
+        attempt and either resolves the issue ('status' 2) or hands it back
+        as new ('status' 0), due again at 'next_attempt'. Only an issue
+        accepted by 'name' can be resolved with a 'name'; otherwise the issue
+        must not have been accepted meanwhile (ie. by a contact answering
+        after the call was given up on). Returns False if the issue was left
+        alone - accepted or no longer claimed by 'owner'.
+        """
+        if name is not None:
+            statuses = '1, 3'
+        else:
+            statuses = '3'
+
+        self.cur.execute("UPDATE messages SET status=?, employee=?, attempts=attempts+1, last_attempt=?, next_attempt=?, owner=NULL, lease_expires=NULL WHERE id=? AND owner=? AND status IN (%s)" % statuses,
+                         (status, name, int(time.time()), next_attempt, id, owner))
+        finished = self.cur.rowcount == 1
+        self.con.commit()
+        return finished
+
+    @_synchronized
+    def fetchRetries(self):
+        """ Returns (next_attempt, id) of every issue waiting for a retry """
+        self.cur.execute("SELECT id, next_attempt FROM messages WHERE status = 0 AND next_attempt IS NOT NULL")
+        return [(row['next_attempt'], row['id']) for row in self.cur.fetchall()]
+
+    @_synchronized
+    def recordCallAttempts(self, attempts, before=None):
+        """
+        Inserts 'attempts' - (contact, message_id, date, hour, answered,
+        ring_time, accepted) tuples - and drops the attempts dated before
+        'before', in one transaction.
+        """
+        self.cur.executemany("INSERT INTO call_attempts (contact, message_id, date, hour, answered, ring_time, accepted) VALUES (?, ?, ?, ?, ?, ?, ?)", attempts)
+        if before is not None:
+            self.cur.execute("DELETE FROM call_attempts WHERE date < ?", (before,))
+        self.con.commit()
+
+    @_synchronized
+    def fetchContactStats(self, since, hours=None):
+        """
+        Returns {contact : (attempts, answered, answer_ms, miss_ms)} for the
+        calls made since 'since' (at one of 'hours', if given); answer_ms
+        and miss_ms are the average ring times of answered and unanswered
+        calls (None without such calls).
+        """
+        query = "SELECT contact, COUNT(*) AS attempts, SUM(answered) AS answered, " + \
+                "AVG(CASE WHEN answered THEN ring_time END) AS answer_ms, AVG(CASE WHEN answered THEN NULL ELSE ring_time END) AS miss_ms " + \
+                "FROM call_attempts WHERE date >= ?"
+        params = [since]
+        if hours is not None:
+            query += " AND hour IN (%s)" % ', '.join(['?'] * len(hours))
+            params.extend(hours)
+        self.cur.execute(query + " GROUP BY contact", params)
+        return dict([(row['contact'], (row['attempts'], row['answered'], row['answer_ms'], row['miss_ms'])) for row in self.cur.fetchall()])
+
+    @_synchronized
+    def renewClaims(self, owner, ids, lease):
+        """ Extends the lease of the issues in 'ids' still claimed by 'owner' """
+        if not ids:
+            return
+        self.cur.execute("UPDATE messages SET lease_expires=? WHERE status=3 AND owner=? AND id IN (%s)" % ', '.join(['?'] * len(ids)), [int(time.time()) + lease, owner] + list(ids))
+        self.con.commit()
+
+    @_synchronized
+    def releaseClaims(self, owner, ids, next_attempt=None):
+        """
+        Hands issues claimed by 'owner' back as new/unhandled (due again at
+        'next_attempt'), without counting a dispatch round
+        """
+        if not ids:
+            return
+        self.cur.execute("UPDATE messages SET status=0, owner=NULL, lease_expires=NULL, next_attempt=? WHERE status=3 AND owner=? AND id IN (%s)" % ', '.join(['?'] * len(ids)),
+                         [next_attempt, owner] + list(ids))
+        self.con.commit()
+
+    @_synchronized
+    def archiveResolved(self, before, limit, archive_db=None):
+        """
+        Moves up to 'limit' resolved issues (status 1/2) dated before
+        'before' into 'messages_archive', and the recordings attached to them
+        into 'message_recordings_archive' - in this db, or in 'archive_db' if
+        given. Rows are copied first and only deleted from 'messages' once
+        the copy has been committed, so a crash can never lose an issue.
+        Returns the number of moved issues.
+        """
+        schema = self._attachArchive(archive_db)
+
+        # The batch is selected by id range rather than a list of ids;
+        # SQLite limits the number of bound parameters (999 before 3.32)
+        self.cur.execute("SELECT MAX(id) FROM (SELECT id FROM messages WHERE status IN (1, 2) AND date < ? ORDER BY id LIMIT ?)", (before, limit))
+        max_id = self.cur.fetchone()[0]
+        if max_id is None:
+            return 0
+
+        columns = self._syncArchiveTable(schema)
+        batch = "status IN (1, 2) AND date < ? AND id <= ?"
+
+        self.cur.execute("INSERT OR IGNORE INTO %s.messages_archive (%s, archived_at) SELECT %s, ? FROM messages WHERE %s" %
+                         (schema, ', '.join(columns), ', '.join(columns), batch), (_Misc.getTime(), before, max_id))
+        self.cur.execute("INSERT OR IGNORE INTO %s.message_recordings_archive (id, message_id, msg_id, caller_id, date) " % schema +
+                         "SELECT id, message_id, msg_id, caller_id, date FROM message_recordings WHERE message_id IN (SELECT id FROM messages WHERE %s)" % batch,
+                         (before, max_id))
+        self.con.commit()
+
+        self.cur.execute("DELETE FROM message_recordings WHERE message_id IN (SELECT id FROM %s.messages_archive WHERE id <= ?) AND id IN (SELECT id FROM %s.message_recordings_archive)" % (schema, schema), (max_id,))
+        self.cur.execute("DELETE FROM messages WHERE %s AND id IN (SELECT id FROM %s.messages_archive WHERE id <= ?)" % (batch, schema), (before, max_id, max_id))
+        moved = self.cur.rowcount
+        self.con.commit()
+        return moved
+
+    def _attachArchive(self, archive_db):
+        if not archive_db:
+            return 'main'
+
+        if getattr(self, 'attached', None) != archive_db:
+            self.cur.execute("ATTACH DATABASE ? AS archive", (archive_db,))
+            self.attached = archive_db
+        return 'archive'
+
+    def _syncArchiveTable(self, schema):
+        """
+        Creates/extends the archive table to hold every 'messages' column
+        (migrations may have added some since), and creates the recordings
+        archive table. Returns the 'messages' column names.
+        """
+        self.cur.execute("PRAGMA main.table_info(messages)")
+        columns = [(row['name'], row['type']) for row in self.cur.fetchall()]
+
+        self.cur.execute("CREATE TABLE IF NOT EXISTS %s.messages_archive (id INTEGER PRIMARY KEY, archived_at TEXT)" % schema)
+        self.cur.execute("CREATE TABLE IF NOT EXISTS %s.message_recordings_archive (id INTEGER PRIMARY KEY, message_id INT NOT NULL, msg_id TEXT NOT NULL, caller_id INT, date TEXT)" % schema)
+        self.cur.execute("CREATE INDEX IF NOT EXISTS %s.message_recordings_archive_message_id ON message_recordings_archive(message_id)" % schema)
+        self.cur.execute("PRAGMA %s.table_info(messages_archive)" % schema)
+        existing = [row['name'] for row in self.cur.fetchall()]
+
+        for (name, type) in columns:
+            if name not in existing:
+                self.cur.execute("ALTER TABLE %s.messages_archive ADD COLUMN %s %s" % (schema, name, type))
+
+        self.con.commit()
+        return [name for (name, type) in columns]
+
+    @_synchronized
+    def incrementalVacuum(self, pages=1000):
+        """
+        Returns up to 'pages' free pages to the file system. Dbs created
+        without incremental auto_vacuum are converted by a one-off VACUUM.
+        """
+        self.cur.execute("PRAGMA auto_vacuum")
+        if self.cur.fetchone()['auto_vacuum'] != 2:
+            self.cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.con.isolation_level = None
+            try:
+                self.cur.execute("VACUUM")
+            finally:
+                self.con.isolation_level = ''
+            return
 
+        self.cur.execute("PRAGMA incremental_vacuum(%d)" % int(pages))
+        self.cur.fetchall()
+
+    @_synchronized
+    def fetchDataVersion(self):
+        self.cur.execute("PRAGMA data_version")
+        row = self.cur.fetchone()
+        if row != None:
+            return row['data_version']
+        return row
+
+    @_synchronized
     def fetchTables(self):
         self.cur.execute("SELECT name FROM SQLite_Master")
         return self.cur.fetchall()
 
-    # custom row factory for sqlite3; returns dicts instead of tuples
-    def _dictFactory(self, cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
-
     @classmethod
     def setupDatabase(cls, file):
         try:
@@ -674,6 +3759,7 @@ class _SQL:
             # Insert dummy account
             sql.cur.execute("INSERT INTO clients (name, pin) VALUES ('Test Client', '1111')")
             sql.con.commit()
+            sql.upgradeSchema()
             sql.cur.close()
         except Exception, e:
             return (False, e)
@@ -723,13 +3809,167 @@ class _Config:
         self.required_sections = {'main'   : self.required_main, 
                                   'groups' : self.required_group}
 
-    def parse(self):
+        # Optional options -> (default, validation function); missing options
+        # are filled in with their default value
+        self.optional_main = {'hangup_timeout'       : (180, self._checkHangupTimeout),
+                              'queue_poll_interval'  : (0.5, self._checkPollInterval),
+                              'fastagi_host'         : ('127.0.0.1', None),
+                              'fastagi_port'         : (4573, self._checkPort),
+                              'fastagi_max_children' : (40, self._checkMaxChildren),
+                              'swift_path'           : ('swift', None),
+                              'metrics_host'         : ('127.0.0.1', None),
+                              'metrics_port'         : (False, self._checkMetricsPort),
+                              'metrics_textfile'     : (False, self._checkMetricsTextfile)}
+
+        self.optional_group = {'max_concurrent_calls'   : (1, self._checkConcurrency),
+                               'claim_batch'            : (25, self._checkClaimBatch),
+                               'claim_lease'            : (900, self._checkClaimLease),
+                               'archive_after_days'     : (False, self._checkArchiveAfter),
+                               'spool_dir'              : (False, self._checkOptionalDir),
+                               'attachment_budget'      : (10485760, self._checkByteSize),
+                               'prompt_cache_dir'       : (False, self._checkOptionalDir),
+                               'prompt_cache_size'      : (0, self._checkByteSize),
+                               'tts_voice'              : (False, None),
+                               'archive_database'       : (False, self._checkArchiveDatabase),
+                               'archive_batch'          : (1000, self._checkArchiveBatch),
+                               'message_retention_days' : (False, self._checkRetention),
+                               'ring_strategy'          : ('sequential', self._checkRingStrategy),
+                               'ring_stagger'           : (10, self._checkRingStagger),
+                               'timezone'               : (False, self._checkTimezone),
+                               'log_format'             : ('text', self._checkLogFormat),
+                               'log_async'              : (False, self._checkBool),
+                               'retry_interval'         : (60, self._checkRetryInterval),
+                               'retry_interval_max'     : (3600, self._checkRetryInterval),
+                               'coalesce_window'        : (False, self._checkCoalesceWindow),
+                               'batch_calls'            : (False, self._checkBool),
+                               'contact_order'          : ('priority', self._checkContactOrder),
+                               'contact_stats_days'     : (14, self._checkContactStatsDays)}
+
+        self.optional_sections = {'main'   : self.optional_main,
+                                  'groups' : self.optional_group}
+
+    def parse(self, use_cache=True):
+        """
+        Returns tuple (bool status, config||string error) for self.group.
+        Unless 'use_cache' is False, a config validated earlier is served from
+        the config cache as long as the config file has not changed since.
+        """
+        if use_cache:
+            cached = self._loadCache()
+            if cached is not None and self.group in cached:
+                self.config = cached[self.group]
+                return (True, self.config)
+
+        (status, json_data) = self._loadConfig()
+        if not status:
+            return (False, json_data)
+
+        self.json_data = json_data
+
+        (status, config) = self._validate()
+        if status:
+            self._storeCache({self.group : config})
+        return (status, config)
+
+    def parseAll(self, groups=None):
+        """
+        Validates every hotline group (or only 'groups') after loading the
+        config once. Returns tuple (bool status, {group: config}||string error).
+        Always performs the full validation and refreshes the config cache.
+        """
         (status, json_data) = self._loadConfig()
         if not status:
             return (False, json_data)
 
         self.json_data = json_data
 
+        if 'groups' not in self.json_data:
+            return (False, "Missing section groups")
+
+        if groups is None:
+            groups = self.json_data['groups'].keys()
+
+        if len(groups) == 0:
+            return (False, "No hotline groups defined")
+
+        configs = {}
+        for group in groups:
+            self.group = group
+            (status, config) = self._validate()
+            if not status:
+                return (False, config)
+            configs[group] = config
+
+        self._storeCache(configs)
+        return (True, configs)
+
+    def _cacheFile(self):
+        # One cache per user; a cache written by root (cron) could not be
+        # replaced by the Asterisk user in the sticky temp dir, and vice versa
+        name = 'pyhotline-%s-%s.cache' % (os.getuid(), md5(os.path.abspath(self.config_file)).hexdigest())
+        return os.path.join(tempfile.gettempdir(), name)
+
+    def _cacheKey(self):
+        # The cache is only valid for the exact config file (and module
+        # version/db schema) it was validated from; validation is also what
+        # upgrades the db schema
+        st = os.stat(self.config_file)
+        return [st.st_mtime, st.st_size, __version__, _SQL.schema_version]
+
+    def _loadCache(self):
+        """ Returns the cached {group: config} or None if missing/stale """
+        path = self._cacheFile()
+        try:
+            st = os.lstat(path)
+        except OSError, e:
+            return None
+
+        # Never trust a cache file (or symlink) someone else could have written
+        if st.st_uid != os.getuid() or st.st_mode & 022:
+            sys.stderr.write("[ConfigCache] Ignoring '%s'; owned by uid %s or writable by others\n" % (path, st.st_uid))
+            return None
+
+        try:
+            cache_fh = open(path)
+            data = json.load(cache_fh)
+            cache_fh.close()
+
+            if data['key'] != self._cacheKey():
+                return None
+            return data['groups']
+        except Exception, e:
+            return None
+
+    def _storeCache(self, configs):
+        """ Adds 'configs' to the cache; failures only cost the speedup """
+        path = self._cacheFile()
+        try:
+            groups = self._loadCache() or {}
+            groups.update(configs)
+            data = {'key' : self._cacheKey(), 'groups' : groups}
+
+            # Write to a private temp file first and rename it into place, so
+            # concurrent AGI processes never read a half written cache;
+            # mkstemp() never follows a symlink planted in the temp dir
+            (fd, tmp_path) = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+        except Exception, e:
+            return False
+
+        try:
+            cache_fh = os.fdopen(fd, 'w')
+            json.dump(data, cache_fh)
+            cache_fh.close()
+            os.rename(tmp_path, path)
+        except Exception, e:
+            try:
+                os.remove(tmp_path)
+            except OSError, e:
+                pass
+            return False
+
+        return True
+
+    def _validate(self):
         # Check if sections exist
         for section in self.required_sections:
             if section not in self.json_data:
@@ -741,14 +3981,9 @@ class _Config:
 
         # Perform in-depth checks
         for section, settings in self.required_sections.iteritems():
-            for req_opt, validateFunc in settings.iteritems():
-                # Define where to look for the required options
-                target = None
-                if section == 'groups':
-                    target = self.json_data['groups'][self.group]
-                else:
-                    target = self.json_data[section]
+            target = self._getTarget(section)
 
+            for req_opt, validateFunc in settings.iteritems():
                 # Check if the req option is defined
                 if req_opt not in target:
                     return (False, "Missing required option '%s' in section '%s'" % (req_opt, section))
@@ -764,14 +3999,39 @@ class _Config:
                 # Perform the validation function
                 (status, message) = validateFunc(target[req_opt])
                 if not status:
-                    if section == 'groups':
-                        return (False, "(groups->%s->%s) %s" % (self.group, req_opt, message))
-                    return (False, "(%s->%s) %s" % (section, req_opt, message)) 
+                    return (False, self._formatError(section, req_opt, message))
+
+        # Fill in defaults for, or validate, the optional options
+        for section, settings in self.optional_sections.iteritems():
+            target = self._getTarget(section)
+
+            for opt, (default, validateFunc) in settings.iteritems():
+                if opt not in target:
+                    target[opt] = default
+                    continue
+
+                if validateFunc == None:
+                    continue
+
+                (status, message) = validateFunc(target[opt])
+                if not status:
+                    return (False, self._formatError(section, opt, message))
 
         # Return a 'clean' version of the config (include the specific group)
         self.config = dict(self.json_data['groups'][self.group].items() + self.json_data['main'].items())
         return (True, self.config)
 
+    def _getTarget(self, section):
+        # Define where to look for the options of a section
+        if section == 'groups':
+            return self.json_data['groups'][self.group]
+        return self.json_data[section]
+
+    def _formatError(self, section, opt, message):
+        if section == 'groups':
+            return "(groups->%s->%s) %s" % (self.group, opt, message)
+        return "(%s->%s) %s" % (section, opt, message)
+
     def _loadConfig(self):
         if not os.path.exists(self.config_file):
             return(False, "No such file '%s'" % self.config_file)
@@ -804,6 +4064,163 @@ class _Config:
             return (True, '')
         return (False, "Invalid value '%s' (max: %s)" % (value, max))
 
+    def _checkHangupTimeout(self, value):
+        max = 3600
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value > 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (max: %s)" % (value, max))
+
+    def _checkPollInterval(self, value):
+        if type(value) not in (int, float):
+            return (False, "Value is not of numeric type")
+
+        if value >= 0.05 and value <= 60:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 0.05..60)" % value)
+
+    def _checkConcurrency(self, value):
+        max = 50
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 1..%s)" % (value, max))
+
+    def _checkClaimBatch(self, value):
+        max = 500
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 1..%s)" % (value, max))
+
+    def _checkClaimLease(self, value):
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 30 and value <= 86400:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 30..86400)" % value)
+
+    def _checkMetricsPort(self, value):
+        if value == False:
+            return (True, '')
+        return self._checkPort(value)
+
+    def _checkMetricsTextfile(self, value):
+        if value == False:
+            return (True, '')
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(value))):
+            return (False, "Directory of metrics file '%s' does not exist" % value)
+        return (True, '')
+
+    def _checkOptionalDir(self, value):
+        if value == False:
+            return (True, '')
+        return self._checkDir(value)
+
+    def _checkByteSize(self, value):
+        if type(value) != int or value < 0:
+            return (False, "Value has to be a number of bytes (>= 0)")
+        return (True, '')
+
+    def _checkArchiveAfter(self, value):
+        if value == False:
+            return (True, '')
+
+        if type(value) != int or value < 1:
+            return (False, "Value has to be 'false' or a number of days (>= 1)")
+        return (True, '')
+
+    def _checkRetention(self, value):
+        if value == False:
+            return (True, '')
+
+        if type(value) != int or value < 1:
+            return (False, "Value has to be 'false' or a number of days (>= 1)")
+        return (True, '')
+
+    def _checkArchiveDatabase(self, value):
+        if value == False:
+            return (True, '')
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(value))):
+            return (False, "Directory of archive db '%s' does not exist" % value)
+        return (True, '')
+
+    def _checkArchiveBatch(self, value):
+        max = 100000
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 1..%s)" % (value, max))
+
+    def _checkRetryInterval(self, value):
+        # At least a second; 0 would redial an unanswered issue right away
+        min = 1
+        max = 86400
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= min and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed %s..%s)" % (value, min, max))
+
+    def _checkCoalesceWindow(self, value):
+        if value == False:
+            return (True, '')
+
+        if type(value) != int or value < 1:
+            return (False, "Value has to be 'false' or a number of seconds (>= 1)")
+        return (True, '')
+
+    def _checkRingStrategy(self, value):
+        strategies = ['sequential', 'parallel', 'staggered']
+        if value not in strategies:
+            return (False, "Invalid ring strategy '%s' (allowed: %s)" % (value, ', '.join(strategies)))
+        return (True, '')
+
+    def _checkContactOrder(self, value):
+        orders = ['priority', 'adaptive']
+        if value not in orders:
+            return (False, "Invalid contact order '%s' (allowed: %s)" % (value, ', '.join(orders)))
+        return (True, '')
+
+    def _checkContactStatsDays(self, value):
+        max = 365
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 1..%s)" % (value, max))
+
+    def _checkRingStagger(self, value):
+        max = 600
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 1..%s)" % (value, max))
+
+    def _checkMaxChildren(self, value):
+        max = 1000
+        if type(value) != int:
+            return (False, "Value is not of integer type")
+
+        if value >= 1 and value <= max:
+            return (True, '')
+        return (False, "Invalid value '%s' (allowed 1..%s)" % (value, max))
+
     def _checkDir(self, value):
         if not os.path.isdir(value):
             return (False, "'%s' is not a valid directory" % value)
@@ -827,9 +4244,16 @@ class _Config:
         sql = _SQL(value)
         tables = sql.fetchTables()
 
-        if len(tables) > 1:
-            return (True, '')
-        return (False, "SQLite db missing required tables. Consult documentation for creating the initial db.")
+        if len(tables) < 2:
+            return (False, "SQLite db missing required tables. Consult documentation for creating the initial db.")
+
+        # Existing dbs are brought up to the current schema here
+        try:
+            sql.upgradeSchema()
+        except Exception, e:
+            return (False, "Unable to upgrade SQLite db schema. Exception: %s" % e)
+
+        return (True, '')
 
     def _checkFile(self, value):
         if os.path.exists(value):
@@ -850,6 +4274,12 @@ class _Config:
             return (False, "Invalid log level '%s'" % value)
         return (True, '')
 
+    def _checkLogFormat(self, value):
+        formats = ['text', 'json']
+        if value not in formats:
+            return (False, "Invalid log format '%s' (allowed: %s)" % (value, ', '.join(formats)))
+        return (True, '')
+
     def _checkBool(self, value):
         if type(value) == bool:
             return (True, '')
@@ -861,10 +4291,45 @@ class _Config:
 
         allowed = range(0,7)
         for day in value:
+            if type(day) == dict:
+                (status, message) = self._checkWindow(day)
+                if not status:
+                    return (False, message)
+                continue
+
             if day not in allowed:
                 return (False, "Invalid schedule value '%s'" % day)
         return (True, '')
 
+    def _checkWindow(self, value):
+        for opt in ['day', 'from', 'to']:
+            if opt not in value:
+                return (False, "Schedule window is missing '%s'" % opt)
+
+        if value['day'] not in range(0,7):
+            return (False, "Invalid schedule day '%s'" % value['day'])
+
+        for opt in ['from', 'to']:
+            try:
+                _Roster.parseTime(value[opt])
+            except (ValueError, AttributeError):
+                return (False, "Invalid schedule time '%s' (expected 'HH:MM')" % value[opt])
+
+        return (True, '')
+
+    def _checkTimezone(self, value):
+        if value == False:
+            return (True, '')
+
+        if pytz is None:
+            return (False, "Setting a timezone requires the pytz module")
+
+        try:
+            pytz.timezone(value)
+        except Exception, e:
+            return (False, "Unknown timezone '%s'" % value)
+        return (True, '')
+
     def _checkPriority(self, value):
         if type(value) != int:
             return (False, "Value should be of integer type")